@@ -0,0 +1,161 @@
+"""
+BENCHMARKS FOR THE DATA CLEANING HELPERS IN functions.py
+
+run with: python benchmarks.py
+"""
+import os
+import time
+import datetime
+import tempfile
+import numpy as np
+import pandas as pd
+import functions
+
+# row counts every benchmark is run at
+BENCHMARK_SIZES = [100000, 1000000]
+
+
+def legacyCleanupNameWhitespace(df, colName):
+    """the original row-by-row version of functions.cleanupNameWhitespace, kept for comparison"""
+    for index, _row in df.iterrows():
+        df.at[index, colName] = ' '.join(str(df.at[index, colName]).split())
+    return df
+
+def legacyFindDuplicateRecords(df, colName):
+    """the original groupby version of functions.findDuplicateRecords, kept for comparison"""
+    try:
+        return pd.concat(g for _, g in df.groupby(colName) if len(g) > 1)
+    except ValueError:
+        return 'No duplicates were found!'
+
+def legacyFindIncompleteRescues(rescueFile):
+    """the original row-by-row version of functions.findIncompleteRescues, kept for comparison"""
+    rescuesDF = pd.read_csv(rescueFile)
+    rescuesDF = rescuesDF[(rescuesDF['Rescue State'] != 'completed') & (rescuesDF['Rescue State'] != 'canceled')]
+    rescuesDF = rescuesDF.reset_index().drop(axis='columns', columns=['index'])
+    for index, _ in rescuesDF.iterrows():
+        rescuesDF.at[index, 'Day of Pickup Start'] = datetime.datetime.strptime(rescuesDF.at[index, 'Day of Pickup Start'], '%Y-%m-%d').date()
+    today = datetime.date.today()
+    rescuesDF = rescuesDF[rescuesDF['Day of Pickup Start'] < today]
+    return rescuesDF[['Rescue ID', 'Day of Pickup Start', 'Rescue State', 'Rescue Detail URL']].drop_duplicates().reset_index().drop(axis='columns', columns=['index'])
+
+def makeRescuesFile(size, directory, seed=0):
+    """helper function that writes an admin tool style rescue export with `size` rows, about 10% of them incomplete"""
+    rng = np.random.default_rng(seed)
+    states = np.array(['completed'] * 7 + ['canceled'] * 2 + ['active'], dtype=object)
+    pickupDates = pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 365 * 5, size), unit='D')
+    rescuesDF = pd.DataFrame({
+        'Rescue ID': np.arange(size),
+        'Day of Pickup Start': pickupDates.strftime('%Y-%m-%d'),
+        'Rescue State': states[rng.integers(0, len(states), size)],
+        'Description': 'Mixed produce and bakery items',
+        'Food Type': 'Produce',
+        'Weight': rng.integers(1, 500, size),
+        'Rescue Detail URL': 'https://admin.example.org/rescues/' + pd.Series(np.arange(size)).astype(str),
+        'Donor Name': 'Donor',
+        'Donor Location Name': 'Donor Location',
+        'Recipient Name': 'Recipient',
+        'Recipient Location Name': 'Recipient Location',
+        'Volunteer Name': 'Volunteer Name',
+    })
+    rescueFile = os.path.join(directory, 'rescues_' + str(size) + '.csv')
+    rescuesDF.to_csv(rescueFile, index=False)
+    return rescueFile
+
+def makeRecords(size, changedRecords, seed=0):
+    """helper function that makes two copies of `size` Account-like records, `changedRecords` of which are different in the second"""
+    rng = np.random.default_rng(seed)
+    leftDF = pd.DataFrame({
+        'Id': np.arange(size),
+        'Name': np.array(['Donor ' + str(i) for i in range(size)], dtype=object),
+        'Phone': rng.integers(4120000000, 4129999999, size),
+        'CreatedDate': pd.Timestamp('2019-01-01') + pd.to_timedelta(rng.integers(0, 365 * 5, size), unit='D'),
+    })
+    rightDF = leftDF.copy()
+    changed = rng.choice(size, changedRecords, replace=False)
+    rightDF.loc[changed, 'Phone'] = rightDF.loc[changed, 'Phone'] + 1
+    return leftDF, rightDF
+
+def makeNames(size, distinctNames, seed=0):
+    """helper function that makes a column of messy names, `distinctNames` of which are different"""
+    rng = np.random.default_rng(seed)
+    pool = np.array([' Donor  ' + str(i) + '   Location  #' + str(i % 97) + ' ' for i in range(distinctNames)], dtype=object)
+    return pd.DataFrame({'Name': pool[rng.integers(0, distinctNames, size)]})
+
+def timeFunction(function, *args, **kwargs):
+    """helper function that returns how many seconds a single call takes"""
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+def benchmarkCleanupNameWhitespace():
+    """compares the row-by-row and vectorized name cleanup on repeated and all distinct names"""
+    print('cleanupNameWhitespace')
+    for size in BENCHMARK_SIZES:
+        for label, distinctNames in [('repeated names', 5000), ('distinct names', size)]:
+            df = makeNames(size, distinctNames)
+            legacySeconds = timeFunction(legacyCleanupNameWhitespace, df.copy(), 'Name')
+            vectorizedSeconds = timeFunction(functions.cleanupNameWhitespace, df, 'Name')
+            print(f'  {size:>9,} rows, {label}: row-by-row {legacySeconds:8.2f}s, '
+                  f'vectorized {vectorizedSeconds:6.3f}s ({legacySeconds / vectorizedSeconds:,.0f}x faster)')
+
+def benchmarkFindIncompleteRescues():
+    """compares the row-by-row and vectorized incomplete rescue search, reporting the time spent reading the file separately"""
+    print('findIncompleteRescues')
+    with tempfile.TemporaryDirectory() as directory:
+        for size in BENCHMARK_SIZES:
+            rescueFile = makeRescuesFile(size, directory)
+            readSeconds = timeFunction(pd.read_csv, rescueFile,
+                                       usecols=['Rescue ID', 'Day of Pickup Start', 'Rescue State', 'Rescue Detail URL'])
+            legacySeconds = timeFunction(legacyFindIncompleteRescues, rescueFile)
+            vectorizedSeconds = timeFunction(functions.findIncompleteRescues, rescueFile)
+            windowSeconds = timeFunction(functions.findIncompleteRescues, rescueFile, '2023-01-01', '2023-12-31')
+            print(f'  {size:>9,} rows: row-by-row {legacySeconds:8.2f}s, vectorized {vectorizedSeconds:6.3f}s '
+                  f'({legacySeconds / vectorizedSeconds:,.0f}x faster, {vectorizedSeconds - readSeconds:6.3f}s after reading the csv), '
+                  f'one year window {windowSeconds:6.3f}s')
+
+def benchmarkFindDuplicateRecords():
+    """compares the groupby and vectorized exact duplicate search, and times the near duplicate search"""
+    print('findDuplicateRecords')
+    threshold = functions.CONFIG.getFloat('GeneralConfiguration', 'duplicateSimilarityThreshold')
+    for size in BENCHMARK_SIZES:
+        # about half the names appear more than once
+        df = makeNames(size, size // 2)
+        legacySeconds = timeFunction(legacyFindDuplicateRecords, df, 'Name')
+        exactSeconds = timeFunction(functions.findDuplicateRecords, df, 'Name')
+        fuzzySeconds = timeFunction(functions.findDuplicateRecords, df, 'Name', threshold)
+        print(f'  {size:>9,} rows: groupby {legacySeconds:8.2f}s, exact {exactSeconds:6.3f}s '
+              f'({legacySeconds / exactSeconds:,.0f}x faster), with near duplicates {fuzzySeconds:6.2f}s')
+
+def benchmarkDiffRecords():
+    """times diffRecords on mostly unchanged records, next to how long canonicalizing and hashing them takes"""
+    print('diffRecords')
+    schema = {'Name': 'text', 'Phone': 'number', 'CreatedDate': 'date'}
+    for size in BENCHMARK_SIZES:
+        leftDF, rightDF = makeRecords(size, size // 1000)
+        hashSeconds = timeFunction(lambda: [pd.util.hash_pandas_object(functions.canonicalizeRecords(df, schema), index=False)
+                                            for df in (leftDF, rightDF)])
+        diffSeconds = timeFunction(functions.diffRecords, leftDF, rightDF, 'Id', schema)
+        print(f'  {size:>9,} rows, 0.1% changed: diffRecords {diffSeconds:6.3f}s, of which canonicalizing and hashing {hashSeconds:6.3f}s')
+
+def benchmarkLoadAdminExport():
+    """compares reading a whole rescue export with loading only the columns findIncompleteRescues needs"""
+    print('loadAdminExport')
+    columns = ['Rescue ID', 'Day of Pickup Start', 'Rescue State', 'Rescue Detail URL']
+    with tempfile.TemporaryDirectory() as directory:
+        for size in BENCHMARK_SIZES:
+            rescueFile = makeRescuesFile(size, directory)
+            fullSeconds = timeFunction(pd.read_csv, rescueFile)
+            loadSeconds = timeFunction(functions.loadAdminExport, rescueFile, 'rescues', columns)
+            fullMegabytes = pd.read_csv(rescueFile).memory_usage(deep=True).sum() / 2 ** 20
+            loadMegabytes = functions.loadAdminExport(rescueFile, 'rescues', columns).memory_usage(deep=True).sum() / 2 ** 20
+            print(f'  {size:>9,} rows: whole file {fullSeconds:6.3f}s {fullMegabytes:7.1f}MB, '
+                  f'4 typed columns {loadSeconds:6.3f}s {loadMegabytes:7.1f}MB')
+
+
+if __name__ == '__main__':
+    benchmarkCleanupNameWhitespace()
+    benchmarkFindIncompleteRescues()
+    benchmarkFindDuplicateRecords()
+    benchmarkDiffRecords()
+    benchmarkLoadAdminExport()
@@ -0,0 +1,319 @@
+"""
+CHECKS FOR THE SALESFORCE UPLOAD AND UPDATE HELPERS IN functions.py AND salesforce.py
+
+run with: python checks.py
+Nothing is sent to Salesforce, the checks run against mirror.PlanningSession, in-memory data and stubbed requests.
+"""
+import os
+import json
+import tempfile
+from io import StringIO
+from unittest import mock
+import requests
+import pandas as pd
+import functions
+import mirror
+import salesforce
+
+
+def makeSalesforceRecords(rescuesDF):
+    """helper function that makes Accounts and Contacts with a donor location, partner location and volunteer, plus their parent accounts"""
+    foodDonor = functions.getConfigValue('RecordTypeId', 'foodDonor')
+    nonprofitPartner = functions.getConfigValue('RecordTypeId', 'nonProfitPartner')
+    return {
+        'Account': pd.DataFrame({
+            'Id': ['001P', '001L', '001Q', '001R'],
+            'Name': ['Giant Eagle', 'Giant Eagle #12', 'Food Bank', 'Food Bank Oakland'],
+            'RecordTypeId': [foodDonor, foodDonor, nonprofitPartner, nonprofitPartner]
+        }),
+        'Contact': pd.DataFrame({
+            'Id': ['003V'],
+            'Name': ['Jane Doe'],
+            'AccountId': [functions.getConfigValue('AccountId', 'volunteers')]
+        }),
+        'Food_Rescue__c': rescuesDF
+    }
+
+def makeSalesforceRescue(**changes):
+    """helper function that makes the Salesforce copy of the rescue in makeAdminRescuesFile, with `changes` applied"""
+    rescue = {
+        'Id': 'a01', 'Rescue_Id__c': 7.0, functions.SALESFORCE_SITE_PRIMARY_KEY: 'PK7', 'State__c': 'completed',
+        'Day_of_Pickup__c': '2023-01-02', 'Description__c': 'Bread', 'Food_Type__c': 'Bakery', 'Weight__c': 12.0,
+        'Rescue_Detail_URL__c': 'https://admin.example.org/rescues/7', 'Comments__c': None,
+        'Food_Donor_Account_Name__c': '001L', 'Agency_Name__c': '001R', 'Volunteer_Name__c': '003V'
+    }
+    rescue.update(changes)
+    return pd.DataFrame([rescue])
+
+def makeAdminRescuesFile(directory):
+    """helper function that writes an admin tool rescue export with one rescue, names spaced differently than in Salesforce"""
+    rescuesDF = pd.DataFrame({
+        functions.ADMIN_SITE_PRIMARY_KEY: ['PK7'], 'Rescue ID': [7], 'Day of Pickup Start': ['2023-01-02'],
+        'Rescue State': ['completed'], 'Description': ['Bread'], 'Food Type': ['Bakery'], 'Weight': [12],
+        'Rescue Detail URL': ['https://admin.example.org/rescues/7'],
+        'Donor Name': ['Giant Eagle'], 'Donor Location Name': ['Giant Eagle  #12'],
+        'Recipient Name': ['Food Bank'], 'Recipient Location Name': ['Food Bank Oakland'],
+        'Volunteer Name': ['Jane  Doe']
+    })
+    rescueFile = os.path.join(directory, 'rescues.csv')
+    rescuesDF.to_csv(rescueFile, index=False)
+    return rescueFile
+
+def checkResolveRescueDiscrepancies():
+    """checks that a rescue in sync isn't updated, and that a changed one is linked to the location accounts like uploadFoodRescues does"""
+    print('resolveRescueDiscrepancies')
+    with tempfile.TemporaryDirectory() as directory:
+        rescueFile = makeAdminRescuesFile(directory)
+
+        session = mirror.PlanningSession(makeSalesforceRecords(makeSalesforceRescue()))
+        reportDF = functions.resolveRescueDiscrepancies(session, rescueFile)
+        assert reportDF.empty, reportDF
+        assert session.getPlan().empty, session.getPlan()
+
+        session = mirror.PlanningSession(makeSalesforceRecords(makeSalesforceRescue(
+            Food_Donor_Account_Name__c='001P', Agency_Name__c='001Q', Volunteer_Name__c=None)))
+        reportDF = functions.resolveRescueDiscrepancies(session, rescueFile)
+        assert (reportDF['Status'] == 'Updated').all(), reportDF
+        payload = session.steps[0]['Payloads'][0]
+        updateDF = pd.read_csv(StringIO(payload), dtype=str)
+        assert updateDF.to_dict('records') == [{'Id': 'a01', 'Food_Donor_Account_Name__c': '001L', 'Agency_Name__c': '001R',
+                                                 'Volunteer_Name__c': '003V'}], payload
+    print('  ok')
+
+def checkPlanningWithDefaultMirror():
+    """checks that the rescue comparison and update run in plan mode against the default mirror, laid out as refresh() stores it"""
+    print('PlanningSession with the default mirror')
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['LMFR_GENERALCONFIGURATION_SNAPSHOTDIRECTORY'] = directory
+        functions.CONFIG.reload(force=True)
+        try:
+            rescueFile = makeAdminRescuesFile(directory)
+            salesforceMirror = mirror.SalesforceMirror()
+            records = makeSalesforceRecords(makeSalesforceRescue(Weight__c=15.0))
+            for objectType, (fields, _) in mirror.MIRRORED_OBJECTS.items():
+                salesforceMirror.storeDataframe(objectType, records[objectType].reindex(columns=fields))
+            salesforceMirror.connection.close()
+
+            session = mirror.PlanningSession()
+            comparisonDF = functions.compareAdminAndSalesforceRescues(session, rescueFile)
+            assert list(comparisonDF.index) == ['PK7'], comparisonDF
+            reportDF = functions.resolveRescueDiscrepancies(session, rescueFile)
+            assert reportDF[['Field', 'Admin', 'Status']].to_dict('records') == [{'Field': 'Weight__c', 'Admin': 12.0, 'Status': 'Updated'}], reportDF
+            assert session.getPlan()['Operation'].tolist() == ['update'], session.getPlan()
+        finally:
+            del os.environ['LMFR_GENERALCONFIGURATION_SNAPSHOTDIRECTORY']
+            functions.CONFIG.reload(force=True)
+    print('  ok')
+
+def checkSplitCsvPayload():
+    """checks that splitting an ingest payload and reading the pieces back gives the same records, whatever is in the quoted fields"""
+    print('_splitCsvPayload')
+    recordsDF = pd.DataFrame({
+        'Name': ['Plain', 'Comma, inside', 'Two\nlines', 'Quote "inside"', '"\n"', 'Ünïcödé', 'Odd "quote\nacross', ''],
+        'Description__c': ['a', 'b\n\nc', 'd', '""', 'e,f', 'g', 'h', 'i']
+    })
+    csvData = recordsDF.to_csv(index=False, lineterminator='\n')
+    header = csvData.split('\n')[0]
+
+    for maxBytes in [10, 40, 80, len(csvData.encode('utf-8'))]:
+        chunks = list(salesforce._splitCsvPayload(csvData, maxBytes))
+        for chunk in chunks:
+            assert chunk.startswith(header + '\n'), chunk
+            records = list(salesforce._iterCsvRecords(chunk))
+            # a piece only goes over maxBytes when it holds a single record that is bigger on its own
+            assert len(chunk.encode('utf-8')) <= maxBytes or len(records) == 2, (maxBytes, chunk)
+        splitDF = pd.concat([pd.read_csv(StringIO(chunk), dtype=str, keep_default_na=False) for chunk in chunks], ignore_index=True)
+        pd.testing.assert_frame_equal(splitDF, recordsDF)
+
+    # a record bigger than maxBytes is sent on its own instead of being dropped or cut
+    bigDF = pd.DataFrame({'Name': ['small', 'x' * 500 + '\n' + 'y' * 500, 'small']})
+    chunks = list(salesforce._splitCsvPayload(bigDF.to_csv(index=False, lineterminator='\n'), 100))
+    assert len(chunks) == 3, chunks
+    assert pd.read_csv(StringIO(chunks[1]), dtype=str)['Name'].tolist() == [bigDF.at[1, 'Name']]
+    print('  ok')
+
+def checkParseIngestErrors():
+    """checks that ingest errors are split into their code and message"""
+    print('_parseIngestErrors')
+    failedDF = pd.DataFrame({'sf__Id': ['', '', '', ''], 'sf__Error': [
+        'UNABLE_TO_LOCK_ROW:unable to obtain exclusive access to this record:--',
+        'REQUIRED_FIELD_MISSING:Required fields are missing: [LastName]:LastName --',
+        'something odd happened',
+        None
+    ]})
+    parsedDF = salesforce._parseIngestErrors(failedDF)
+    assert parsedDF['Error Code'].tolist() == ['UNABLE_TO_LOCK_ROW', 'REQUIRED_FIELD_MISSING', 'UNKNOWN', 'UNKNOWN'], parsedDF
+    assert parsedDF['Error Message'].tolist() == ['unable to obtain exclusive access to this record:--',
+                                                  'Required fields are missing: [LastName]:LastName --',
+                                                  'something odd happened', ''], parsedDF
+    assert parsedDF['Error Code'].isin(salesforce.RETRYABLE_INGEST_ERRORS).tolist() == [True, False, False, False]
+    print('  ok')
+
+class StubTransport(requests.adapters.BaseAdapter):
+    """helper transport that answers each request with the next of `answers`, a (status code, headers[, JSON body]) tuple or an exception to raise"""
+
+    def __init__(self, answers):
+        super().__init__()
+        self.answers = list(answers)
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        response = requests.Response()
+        response.status_code, headers, *body = answer
+        response.headers.update(headers)
+        response._content = json.dumps(body[0] if body else {}).encode('utf-8')
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+def makeStubSession(answers, login=None):
+    """helper function that makes a salesforce.SalesforceSession whose requests are answered by a StubTransport"""
+    session = salesforce.SalesforceSession(login)
+    transport = StubTransport(answers)
+    session.mount('https://', transport)
+    session.mount('http://', transport)
+    return session, transport
+
+def checkSessionRetries():
+    """checks which requests SalesforceSession retries, how long it waits, and that it logs in again when the session expired"""
+    print('SalesforceSession.request')
+    url = 'https://example.my.salesforce.com/services/data/v56.0/jobs/ingest/'
+    with mock.patch('time.sleep') as sleep:
+        # throttled: wait at least as long as Retry-After asks
+        session, transport = makeStubSession([(429, {'Retry-After': '30'}), (200, {})])
+        assert session.get(url).status_code == 200
+        assert len(transport.requests) == 2 and sleep.call_args.args[0] >= 30, sleep.call_args_list
+
+        # a POST turned away is retried, one that may have been acted on isn't
+        session, transport = makeStubSession([(503, {}), (200, {})])
+        assert session.post(url).status_code == 200 and len(transport.requests) == 2
+        session, transport = makeStubSession([(502, {}), (200, {})])
+        assert session.post(url).status_code == 502 and len(transport.requests) == 1
+
+        # a 401 after the last retry still logs in again and returns the answer to the retried request
+        logins = []
+        def login():
+            logins.append(len(logins))
+            return 'SESSION' + str(len(logins)), None
+        session, transport = makeStubSession([(503, {})] * salesforce.MAX_RETRIES + [(401, {}), (200, {})], login)
+        response = session.get(url)
+        assert response is not None and response.status_code == 200, response
+        assert len(logins) == 2 and transport.requests[-1].headers['Authorization'] == 'Bearer SESSION2'
+
+        # a POST that never connected is retried until MAX_RETRIES, one that timed out reading isn't
+        session, transport = makeStubSession([requests.ConnectTimeout('connect timeout')] * (salesforce.MAX_RETRIES + 1))
+        sleep.reset_mock()
+        try:
+            session.post(url)
+            raise AssertionError('a request that never connects should raise')
+        except salesforce.SalesforceUnavailableError:
+            pass
+        assert len(transport.requests) == salesforce.MAX_RETRIES + 1 and sleep.call_count == salesforce.MAX_RETRIES
+        session, transport = makeStubSession([requests.ReadTimeout('read timeout'), (200, {})])
+        try:
+            session.post(url)
+            raise AssertionError('a POST that timed out reading should not be retried')
+        except salesforce.SalesforceUnavailableError:
+            pass
+        assert len(transport.requests) == 1
+    print('  ok')
+
+def checkRetryFailedRows():
+    """checks that rows that failed with a temporary error are sent again until only a row that keeps failing is left"""
+    print('_retryFailedRows')
+    calls = []
+
+    def runIngestJobs(operation, chunks, objectType, externalIdFieldName, session, uri, fetchSuccessfulResults, reuseJobs=True):
+        # the locked row fails every time, the others go through
+        assert len(calls) < 50, 'the retries should end'
+        calls.append(chunks[0])
+        payloadDF = pd.read_csv(StringIO(chunks[0]), dtype=str)
+        failedDF = payloadDF[payloadDF['LastName'] == 'Locked']
+        failedDF.insert(0, 'sf__Error', 'UNABLE_TO_LOCK_ROW:unable to obtain exclusive access to this record:--')
+        failedDF.insert(0, 'sf__Id', '')
+        return salesforce.IngestResult(operation, objectType, ['750' + str(len(calls))], len(payloadDF), len(failedDF),
+                                       failedResults=failedDF.reset_index(drop=True))
+
+    payloadDF = pd.DataFrame({'LastName': ['A', 'B', 'Locked', 'C', 'D', 'E', 'Missing'],
+                              'AccountId': ['001A', '001B', '001A', '001B', '001A', '001B', '001A']})
+    failedDF = payloadDF.copy()
+    failedDF.insert(0, 'sf__Error', ['UNABLE_TO_LOCK_ROW:unable to obtain exclusive access to this record:--'] * 6
+                    + ['REQUIRED_FIELD_MISSING:Required fields are missing: [Email]:Email --'])
+    failedDF.insert(0, 'sf__Id', '')
+    result = salesforce.IngestResult('insert', 'Contact', ['7500'], 7, 7, failedResults=salesforce._parseIngestErrors(failedDF))
+
+    with mock.patch.object(salesforce, '_runIngestJobs', runIngestJobs), mock.patch.object(salesforce, 'INGEST_RETRY_DELAY', 0):
+        salesforce._retryFailedRows(result, None, None, 'https://example.my.salesforce.com/', False)
+
+    assert sorted(result.failedResults['LastName']) == ['Locked', 'Missing'], result.failedResults
+    assert result.numberRecordsFailed == len(result.failedResults) == 2
+    assert result.numberRecordsProcessed == 7 and result.jobIds == ['7500'] + ['750' + str(i) for i in range(1, len(calls) + 1)]
+    # the first retry holds all six rows, records sharing a parent go together
+    assert pd.read_csv(StringIO(calls[0]))['AccountId'].tolist() == ['001A'] * 3 + ['001B'] * 3, calls[0]
+    print('  ok')
+
+def checkResumeCheckpointedRun():
+    """checks that continuing a stopped run skips its finished stages, reuses its finished jobs and deletes the journal once done"""
+    print('checkpointedRun')
+    uri = functions.getConfigValue('GeneralConfiguration', 'uri')
+    contactsCsv = pd.DataFrame({'LastName': ['Doe'], 'AccountId': ['001V']}).to_csv(index=False)
+    stagesRun = []
+
+    def uploadContacts(session):
+        stagesRun.append('Contacts')
+        result = salesforce.executeSalesforceIngestJob('insert', contactsCsv, 'Contact', session)
+        assert result.jobIds == ['750A'] and result.numberRecordsProcessed == 1, result
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['LMFR_GENERALCONFIGURATION_SNAPSHOTDIRECTORY'] = directory
+        functions.CONFIG.reload(force=True)
+        try:
+            # the first attempt finished the accounts and the contacts job, then stopped
+            session, transport = makeStubSession([])
+            try:
+                with salesforce.checkpointedRun('check', session, ['contacts.csv']) as journal:
+                    path = journal.path
+                    journal.record(event='stage', stage='Accounts')
+                    salesforce._recordJobState(journal, salesforce._hashIngestPayload('insert', 'Contact', None, contactsCsv), '750A',
+                                               'insert', 'Contact', {'state': 'JobComplete', 'numberRecordsProcessed': 1, 'numberRecordsFailed': 0})
+                    raise KeyboardInterrupt
+            except KeyboardInterrupt:
+                pass
+            assert os.path.exists(path)
+
+            session, transport = makeStubSession([(200, {}, {'id': '750A', 'state': 'JobComplete', 'numberRecordsProcessed': 1,
+                                                             'numberRecordsFailed': 0})])
+            with mock.patch('time.sleep'):
+                with salesforce.checkpointedRun('check', session, ['contacts.csv']) as journal:
+                    assert journal.path == path and journal.resumed
+                    timelineDF = functions.runStages({
+                        'Accounts': (lambda: stagesRun.append('Accounts'), []),
+                        'Contacts': (lambda: uploadContacts(session), ['Accounts'])
+                    })
+
+            assert stagesRun == ['Contacts'], stagesRun
+            assert timelineDF['Status'].tolist() == ['Done (earlier attempt)', 'Done'], timelineDF
+            # the job was only checked on, not created again
+            assert [(request.method, request.url) for request in transport.requests] == [('GET', uri + 'ingest/750A')], transport.requests
+            assert not os.path.exists(path)
+        finally:
+            del os.environ['LMFR_GENERALCONFIGURATION_SNAPSHOTDIRECTORY']
+            functions.CONFIG.reload(force=True)
+    print('  ok')
+
+
+if __name__ == '__main__':
+    checkResolveRescueDiscrepancies()
+    checkPlanningWithDefaultMirror()
+    checkSplitCsvPayload()
+    checkParseIngestErrors()
+    checkSessionRetries()
+    checkRetryFailedRows()
+    checkResumeCheckpointedRun()
@@ -1,7 +1,96 @@
+import os
+import re
+import sys
+import time
+import difflib
 import datetime
+import threading
 import configparser
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
 import pandas as pd
 import salesforce
+import mirror
+
+# Primary keys shared by the admin site's rescues and Salesforce's Food_Rescue__c records
+# Used Right now as place holders
+ADMIN_SITE_PRIMARY_KEY = 'Food Rescue Primary Key'
+SALESFORCE_SITE_PRIMARY_KEY = 'Food_Rescue_Id__c'
+
+# admin site rescue columns and the Food_Rescue__c fields they are uploaded to
+RESCUE_FIELD_NAMES = {
+    ADMIN_SITE_PRIMARY_KEY: SALESFORCE_SITE_PRIMARY_KEY,
+    'Rescue ID': 'Rescue_Id__c',
+    'Day of Pickup Start': 'Day_of_Pickup__c',
+    'Rescue State': 'State__c',
+    'Description': 'Description__c',
+    'Food Type': 'Food_Type__c',
+    'Weight': 'Weight__c',
+    'Rescue Detail URL': 'Rescue_Detail_URL__c'
+}
+
+# fields compared between admin site and Salesforce rescues (named as in Salesforce), and how they are compared (see diffRecords)
+RESCUE_COMPARISON_SCHEMA = {
+    'Rescue_Id__c': 'number',
+    'Food_Type__c': 'text',
+    'Description__c': 'text',
+    'Day_of_Pickup__c': 'date',
+    'Donor_Name': 'text',
+    'Partner_Name': 'text',
+    'Volunteer_Name': 'text',
+    'State__c': 'text',
+    'Weight__c': 'number',
+    'Rescue_Detail_URL__c': 'text'
+}
+
+# columns read from each kind of admin tool export and their dtypes (see loadAdminExport)
+# phone numbers and zip codes are kept as text so they are uploaded exactly as written
+# rescue IDs (None) are left to pandas, which reads them as plain ints, nullable Int64 parses twice as slowly
+ADMIN_EXPORT_SCHEMAS = {
+    'donors': {
+        'Donor name': str, 'Location name': str, 'Status': 'category', 'Phone': str,
+        'Line1': str, 'Line2': str, 'City': str, 'State': str, 'Zip': str
+    },
+    'partners': {
+        'Recipient name': str, 'Location name': str, 'Status': 'category', 'Phone': str,
+        'Line1': str, 'Line2': str, 'City': str, 'State': str, 'Zip': str
+    },
+    'volunteers': {
+        'Name': str, 'Email': str, 'Phone': str, 'Line1': str, 'Line2': str, 'City': str, 'State': str, 'Zip': str
+    },
+    'rescues': {
+        ADMIN_SITE_PRIMARY_KEY: str, 'Rescue ID': None, 'Day of Pickup Start': str, 'Rescue State': 'category',
+        'Description': str, 'Food Type': 'category', 'Weight': 'float64', 'Rescue Detail URL': str,
+        'Donor Name': str, 'Donor Location Name': str, 'Recipient Name': str, 'Recipient Location Name': str,
+        'Volunteer Name': str
+    },
+    'comments': {
+        'Rescue ID': None, 'Comments': str
+    }
+}
+# schema columns that are only read if the export has them, unless they are asked for
+ADMIN_EXPORT_OPTIONAL_COLUMNS = {ADMIN_SITE_PRIMARY_KEY}
+
+# compared rescue fields that are looked up by name, and the Food_Rescue__c fields that hold their Ids
+RESCUE_LOOKUP_FIELD_NAMES = {
+    'Donor_Name': 'Food_Donor_Account_Name__c',
+    'Partner_Name': 'Agency_Name__c',
+    'Volunteer_Name': 'Volunteer_Name__c'
+}
+
+# anything that isn't a letter, digit, underscore or whitespace
+PUNCTUATION_PATTERN = re.compile(r'[^\w\s]')
+
+# name of the configuration file, looked for next to the app, then next to this file, then in the current folder
+CONFIG_FILE_NAME = 'config.ini'
+# how often (in seconds) config.ini is checked for changes
+CONFIG_CHECK_INTERVAL = 2
+# environment variables named LMFR_<SECTION>_<KEY> (e.g. LMFR_GENERALCONFIGURATION_URI) override config.ini
+CONFIG_ENVIRONMENT_PREFIX = 'LMFR_'
+
+# how many of the following names (in sorted order) each name is compared with when looking for near duplicates
+DUPLICATE_WINDOW = 5
 
 ### WRAPPER FUNCTIONS
 def uploadAccounts(salesforceAccountsDF, adminAccountsDF, accountType, session):
@@ -32,30 +121,25 @@ def uploadAccounts(salesforceAccountsDF, adminAccountsDF, accountType, session):
     accountsNotInSalesforceDF['ParentId'] = None
     accountsNotInSalesforceDF['RecordTypeId'] = accountType
 
-    # create empty dataframes for first and second upload jobs
-    uploadDFRows = []
-    uploadDF2Rows = []
-
-    # iterate through accounts to determine parent-child relationships
-    for index, row in accountsNotInSalesforceDF.iterrows():
-        childName = row['Name']
-        parentName = row['Parent Name']
-
-        if childName == parentName:
-            uploadDFRows.append(row.values)
-        elif parentName in salesforceAccountsDF['Name'].values:
-            parentId = salesforceAccountsDF[salesforceAccountsDF['Name'] == parentName]['Id'].item()
-            row['ParentId'] = parentId
-            uploadDFRows.append(row.values)
-        else:
-            # create generic record for the new parent account
-            parentRow = [parentName, parentName, None, None, None, None, None, None, accountType]
-            uploadDFRows.append(parentRow)
-            # add child account to the second job
-            uploadDF2Rows.append(row.values)
+    # index existing account names so each parent is a hash lookup instead of a scan
+    parentIdsByName = getIdsByName(salesforceAccountsDF, accountsNotInSalesforceDF['Parent Name'])
+
+    # split accounts into the ones that are their own parent, the ones whose parent is already in Salesforce,
+    # and the ones whose parent has to be created before they can be linked to it
+    isOwnParent = accountsNotInSalesforceDF['Name'] == accountsNotInSalesforceDF['Parent Name']
+    parentExists = ~isOwnParent & accountsNotInSalesforceDF['Parent Name'].isin(parentIdsByName.index)
+    needsParent = ~isOwnParent & ~parentExists
+    accountsNotInSalesforceDF.loc[parentExists, 'ParentId'] = accountsNotInSalesforceDF.loc[parentExists, 'Parent Name'].map(parentIdsByName)
+
+    # create generic records for new parent accounts that aren't already being uploaded in the first job
+    firstJobNames = accountsNotInSalesforceDF.loc[~needsParent, 'Name']
+    newParentNames = accountsNotInSalesforceDF.loc[needsParent, 'Parent Name'].drop_duplicates()
+    newParentNames = newParentNames[~newParentNames.isin(firstJobNames)]
+    newParentsDF = pd.DataFrame({'Parent Name': newParentNames, 'Name': newParentNames, 'RecordTypeId': accountType},
+                                columns=accountsNotInSalesforceDF.columns)
 
     # prepare dataframe for first upload
-    uploadDF = pd.DataFrame(uploadDFRows, columns=accountsNotInSalesforceDF.columns)
+    uploadDF = pd.concat([accountsNotInSalesforceDF[~needsParent], newParentsDF], ignore_index=True)
     uploadDF.drop_duplicates(inplace=True)
     uploadDF = uploadDF.reset_index().drop(axis='columns', columns=['Parent Name', 'index'])
 
@@ -68,22 +152,22 @@ def uploadAccounts(salesforceAccountsDF, adminAccountsDF, accountType, session):
         uploadDF['ShippingPostalCode'] = uploadDF['ShippingPostalCode'].astype('Int64')
 
     # upload first job to Salesforce
-    salesforce.executeSalesforceIngestJob('insert', uploadDF.to_csv(index=False), 'Account', session)
+    result = salesforce.executeSalesforceIngestJob('insert', uploadDF.to_csv(index=False), 'Account', session, fetchSuccessfulResults=True)
 
-    # pull down new list of Accounts
-    salesforceAccountsDF = salesforce.getDataframeFromSalesforce('SELECT Id, Name, RecordTypeId FROM Account', session)
+    # the second job is only needed for accounts whose parent was just created
+    uploadDF2 = accountsNotInSalesforceDF[needsParent].reset_index(drop=True)
+    if len(uploadDF2) == 0:
+        return
 
-    # clean new Accounts data
-    salesforceAccountsDF = salesforceAccountsDF[salesforceAccountsDF['RecordTypeId'] == accountType]
-    salesforceAccountsDF = salesforceAccountsDF[['Id', 'Name']]
-    salesforceAccountsDF = salesforceAccountsDF.reset_index().drop(axis='columns', columns=['index'])
+    # get the Ids of the new parent accounts from the records the first job created
+    newAccountsDF = result.successfulResults.rename(columns={'sf__Id': 'Id'})
 
     # attach ID of parent to each record
-    uploadDF2 = pd.DataFrame(uploadDF2Rows, columns=accountsNotInSalesforceDF.columns)
-    for index, row in uploadDF2.iterrows():
-        parentName = row['Parent Name']
-        parentId = salesforceAccountsDF[salesforceAccountsDF['Name'] == parentName]['Id'].item()
-        uploadDF2.at[index, 'ParentId'] = parentId
+    parentIdsByName = getIdsByName(newAccountsDF, uploadDF2['Parent Name'])
+    missingParents = uploadDF2.loc[~uploadDF2['Parent Name'].isin(parentIdsByName.index), 'Parent Name'].unique()
+    if len(missingParents) > 0:
+        raise ValueError('These parent accounts failed to upload, so their child accounts were not uploaded: ' + ', '.join(missingParents))
+    uploadDF2['ParentId'] = uploadDF2['Parent Name'].map(parentIdsByName)
 
     # fix phone number formatting
     if not uploadDF2['Phone'].dtype == 'object':
@@ -97,13 +181,19 @@ def uploadAccounts(salesforceAccountsDF, adminAccountsDF, accountType, session):
     uploadDF2.drop(axis='columns', columns=['Parent Name'], inplace=True)
     salesforce.executeSalesforceIngestJob('insert', uploadDF2.to_csv(index=False), 'Account', session)
 
-def uploadFoodRescues(rescuesDF, session):
-    """generic function to upload Food Rescue data to Salesforce"""
-    # load in Accounts from Salesforce
-    salesforceAccountsDF = salesforce.getDataframeFromSalesforce('SELECT Id, Name, RecordTypeId FROM Account', session)
+def uploadFoodRescues(rescuesDF, session, externalIdFieldName=None):
+    """generic function to upload Food Rescue data to Salesforce
 
-    # load in Contacts from Salesforce
-    salesforceContactsDF = salesforce.getDataframeFromSalesforce('SELECT Id, Name, AccountId FROM Contact', session)
+    If `externalIdFieldName` is given the rescues are upserted on that field, so rescues already
+    in Salesforce are updated instead of duplicated
+    """
+    # load in Accounts and Contacts from Salesforce
+    dataframes = salesforce.getDataframesFromSalesforce({
+        'accounts': 'SELECT Id, Name, RecordTypeId FROM Account',
+        'contacts': 'SELECT Id, Name, AccountId FROM Contact'
+    }, session)
+    salesforceAccountsDF = dataframes['accounts']
+    salesforceContactsDF = dataframes['contacts']
 
     # cleanup rescuesDF
     rescuesDF.drop(axis='columns', columns=['Donor Name', 'Recipient Name'], inplace=True)
@@ -142,19 +232,23 @@ def uploadFoodRescues(rescuesDF, session):
     mergedDF = pd.merge(mergedDF, salesforcePartnersDF, on='Recipient Location Name', how='left')
     mergedDF = pd.merge(mergedDF, salesforceVolunteersDF, on='Volunteer Name', how='left')
 
-    # Drops unneeded columns for upload
-    mergedDF.drop(axis='columns', columns=['Donor Location Name', 'Recipient Location Name', 'Volunteer Name'], inplace=True)
-
-    # Renames columns for upload
-    mergedDF.columns=['Rescue_Id__c', 'Day_of_Pickup__c', 'State__c', 'Description__c', 'Food_Type__c', 'Weight__c', 'Rescue_Detail_URL__c', 'Food_Donor_Account_Name__c', 'Agency_Name__c', 'Volunteer_Name__c']
+    # Renames columns for upload and drops the ones that aren't uploaded
+    mergedDF = mergedDF.rename(columns=RESCUE_FIELD_NAMES)
+    uploadColumns = ['Rescue_Id__c', 'Day_of_Pickup__c', 'State__c', 'Description__c', 'Food_Type__c', 'Weight__c', 'Rescue_Detail_URL__c', 'Food_Donor_Account_Name__c', 'Agency_Name__c', 'Volunteer_Name__c']
+    if externalIdFieldName is not None:
+        uploadColumns = [externalIdFieldName] + uploadColumns
+    mergedDF = mergedDF[uploadColumns]
 
     # upload rescues to Salesforce
-    salesforce.executeSalesforceIngestJob('insert', mergedDF.to_csv(index=False), 'Food_Rescue__c', session)
+    if externalIdFieldName is None:
+        salesforce.executeSalesforceIngestJob('insert', mergedDF.to_csv(index=False), 'Food_Rescue__c', session)
+    else:
+        salesforce.executeSalesforceIngestJob('upsert', mergedDF.to_csv(index=False), 'Food_Rescue__c', session, externalIdFieldName)
 
 def uploadFoodDonors(accountsDF, session, donorFile):
     """wrapper function to upload Food Donors to Salesforce"""
     # load in donor data from admin tool
-    donorsDF = pd.read_csv(donorFile)
+    donorsDF = loadAdminExport(donorFile, 'donors')
 
     # filter out inactive accounts and unnecessary data columns
     donorsDF = donorsDF[donorsDF['Status'] == 'Active']
@@ -166,7 +260,7 @@ def uploadFoodDonors(accountsDF, session, donorFile):
 def uploadNonprofitPartners(accountsDF, session, nonprofitPartner):
     """wrapper function to upload Nonprofit Partners"""
     # load in partner data from admin tool
-    partnersDF = pd.read_csv(nonprofitPartner)
+    partnersDF = loadAdminExport(nonprofitPartner, 'partners')
 
     # filter out inactive accounts and unnecessary data columns
     partnersDF = partnersDF[partnersDF['Status'] == 'Active']
@@ -178,7 +272,7 @@ def uploadNonprofitPartners(accountsDF, session, nonprofitPartner):
 def uploadVolunteers(contactsDF, session, volunteerFile):
     """wrapper function to upload Volunteers"""
     # load volunteer data from admin tool
-    volunteersDF = pd.read_csv(volunteerFile)
+    volunteersDF = loadAdminExport(volunteerFile, 'volunteers')
 
     # filter all Contacts to just get Food Rescue Heroes
     salesforceVolunteersDF = contactsDF[contactsDF['AccountId'] == getConfigValue('AccountId', 'volunteers')]
@@ -190,7 +284,7 @@ def uploadVolunteers(contactsDF, session, volunteerFile):
     #Converts Mailing Address to Salesforce format
     volunteersDF['MailingStreet'] = volunteersDF['Line1'] + (' ' + volunteersDF['Line2'].fillna(''))
     volunteersDF.drop(axis='columns', columns=['Line1','Line2'], inplace=True)
-    volunteersDF.columns = ['Name', 'Email', 'Phone', 'MailingStreet', 'MailingCity', 'MailingState', 'MailingPostalCode']
+    volunteersDF = volunteersDF.rename(columns={'City': 'MailingCity', 'State': 'MailingState', 'Zip': 'MailingPostalCode'})
 
     # cleanup whitespace in the Name fields to increase matches
     volunteersDF = cleanupNameWhitespace(volunteersDF, 'Name')
@@ -205,7 +299,8 @@ def uploadVolunteers(contactsDF, session, volunteerFile):
     volunteersNotInSalesforceDF['AccountId'] = getConfigValue('AccountId', 'volunteers')
 
     # Formats Phone Datatype
-    volunteersNotInSalesforceDF['Phone'] = volunteersNotInSalesforceDF['Phone'].astype('Int64')
+    if not volunteersNotInSalesforceDF['Phone'].dtype == 'object':
+        volunteersNotInSalesforceDF['Phone'] = volunteersNotInSalesforceDF['Phone'].astype('Int64')
 
     # split Name column into FirstName and LastName columns
     volunteersNotInSalesforceDF['FirstName'] = volunteersNotInSalesforceDF['Name'].apply(lambda x: (' '.join(x.split()[0:-1])))
@@ -221,10 +316,10 @@ def uploadVolunteers(contactsDF, session, volunteerFile):
 def uploadNewFoodRescues(session, rescueFile):
     """wrapper function that finds all new Food Rescues and uploads them to Salesforce"""
     # read in all rescues from admin tool
-    rescuesDF = pd.read_csv(rescueFile)
+    rescuesDF = loadAdminExport(rescueFile, 'rescues')
 
     # read in all rescues currently in Salesforce
-    salesforceRescuesDF = salesforce.getDataframeFromSalesforce('SELECT Id, Rescue_Id__c, Food_Type__c, Weight__c FROM Food_Rescue__c', session).drop_duplicates()
+    salesforceRescuesDF = salesforce.getSyncedDataframe('Food_Rescue__c', ['Id', 'Rescue_Id__c', 'Food_Type__c', 'Weight__c'], session).drop_duplicates()
     salesforceRescuesDF.columns = ['Id', 'Rescue ID', 'Food Type', 'Weight']
 
     # find list of rescues not yet in Salesforce
@@ -235,112 +330,313 @@ def uploadNewFoodRescues(session, rescueFile):
     # upload these new rescues to Salesforce
     uploadFoodRescues(mergedDF, session)
 
-def uploadDataToSalesforce(accountsDF: pd.DataFrame, contactsDF, session, uri, donorFile=None, nonprofitPartner=None, volunteerFile=None, rescueFile=None):
+def upsertFoodRescues(session, rescueFile):
+    """wrapper function that upserts every Food Rescue in the admin tool export to Salesforce
+
+    Rescues are matched on their primary key, so new rescues are inserted and edited ones are updated
+    without downloading the rescues already in Salesforce
+    """
+    # read in all rescues from admin tool, including the primary key they are matched on
+    rescuesDF = loadAdminExport(rescueFile, 'rescues', list(ADMIN_EXPORT_SCHEMAS['rescues']))
+
+    # upsert them on the primary key shared with the admin tool
+    uploadFoodRescues(rescuesDF, session, SALESFORCE_SITE_PRIMARY_KEY)
+
+def uploadDataToSalesforce(accountsDF: pd.DataFrame, contactsDF, session, uri=None, donorFile=None, nonprofitPartner=None, volunteerFile=None, rescueFile=None, upsertRescues=False):
     """master function to upload new data to Salesforce (Accounts, Contacts, Rescues)
     Files are optional
+
+    Donors, Nonprofit Partners and Volunteers don't depend on each other and are uploaded at the same time,
+    rescues are uploaded once all of them are in Salesforce so they can be linked to them (see runStages).
+    If `upsertRescues` is True, rescues are upserted on their primary key instead of only inserting new ones.
+    The upload is checkpointed, so running it again after it stopped part way continues from there (see salesforce.checkpointedRun).
+    `uri` is no longer used, it is read from config.ini.
+
+    Returns the timeline of the stages that ran
     """
-    # first make sure all new Donors, Nonprofits, and Volunteers are uploaded to Salesforce
-
-    # Upload Food Donors
-    if donorFile != "" and donorFile is not None:
-        print('-----------------------------')
-        print('Checking for new Food Donors:')
-        print('-----------------------------')
-        uploadFoodDonors(accountsDF, session, donorFile)
-
-    # Upload NonProfit Partners
-    if nonprofitPartner != "" and nonprofitPartner is not None:
-        print('------------------------------------')
-        print('Checking for new Nonprofit Partners:')
-        print('------------------------------------')
-        uploadNonprofitPartners(accountsDF, session, nonprofitPartner)
-
-    # Upload Volunteers
-    if volunteerFile != "" and volunteerFile is not None:
-        print('----------------------------')
-        print('Checking for new Volunteers:')
-        print('----------------------------')
-        uploadVolunteers(contactsDF, session, volunteerFile)
-
-    # upload new rescue data
-    if rescueFile != "" and rescueFile is not None:
-        print('-------------------------------')
-        print('Uploading all new Food Rescues:')
-        print('-------------------------------')
-        uploadNewFoodRescues(session, rescueFile)
+    # if the upload stops part way, running it again with the same files continues where it stopped
+    with salesforce.checkpointedRun('upload', session, [donorFile, nonprofitPartner, volunteerFile, rescueFile, upsertRescues]) as journal:
+        # the Accounts and Contacts passed in may have been queried while the stopped attempt's jobs were still running,
+        # query them again now that those jobs are done so their records aren't uploaded twice
+        if journal is not None and journal.resumed:
+            dataframes = salesforce.getDataframesFromSalesforce({
+                'accounts': 'SELECT Id, Name, RecordTypeId FROM Account',
+                'contacts': 'SELECT Id, Name, AccountId FROM Contact'
+            }, session, useCache=False)
+            accountsDF = dataframes['accounts']
+            contactsDF = dataframes['contacts']
+
+        stages = {}
+
+        # first make sure all new Donors, Nonprofits, and Volunteers are uploaded to Salesforce
+
+        # Upload Food Donors
+        if donorFile != "" and donorFile is not None:
+            stages['Food Donors'] = (lambda: uploadFoodDonors(accountsDF, session, donorFile), [])
+
+        # Upload NonProfit Partners
+        if nonprofitPartner != "" and nonprofitPartner is not None:
+            stages['Nonprofit Partners'] = (lambda: uploadNonprofitPartners(accountsDF, session, nonprofitPartner), [])
+
+        # Upload Volunteers
+        if volunteerFile != "" and volunteerFile is not None:
+            stages['Volunteers'] = (lambda: uploadVolunteers(contactsDF, session, volunteerFile), [])
+
+        # upload new rescue data once the accounts and contacts they link to are in Salesforce
+        if rescueFile != "" and rescueFile is not None:
+            if upsertRescues:
+                stages['Food Rescues'] = (lambda: upsertFoodRescues(session, rescueFile), list(stages))
+            else:
+                stages['Food Rescues'] = (lambda: uploadNewFoodRescues(session, rescueFile), list(stages))
+
+        timelineDF = runStages(stages)
 
     print('\nDone!')
+    return timelineDF
 
 def resolveRescueDiscrepancies(session, rescueFile):
-    """DOES NOT WORK.
+    """function that updates the Salesforce rescues that are different from the admin site to match it
 
-    Intention: Finds the Discrepancies between Salesforce and Admin Tool and then uploads them to SalesForce
-    """
-    # TODO Parse Discrepancy Dataframe for what needs to update and format it in a nice way
-    # TODO Update Records in Salesforce to match what is in the admin site. This will probably require some parsing and string comparison to match up Contacts & Accounts with their SalesforceIDs
-    #       It might not, but there is a chance.
+    Only the fields that are different are sent (blank cells are ignored by Salesforce), fields that are
+    blank on the admin site are cleared. Donor and partner location names and volunteer names are looked up
+    in the Salesforce Accounts and Contacts to get their Ids, the same way uploadFoodRescues links them. Large updates are split into several jobs (see
+    salesforce.executeSalesforceIngestJob).
 
-    # DiscrepenciesDF is a multi-index dataframe by columns, with Level 0 being the Column Name, and Level 1 being 'Admin' or 'Salesforce' depending on which Datasource the value came from
-    discrepanciesDF = compareAdminAndSalesforceRescues(session, rescueFile,1,1)
+    Returns a report with one row per changed field of each rescue, with its 'Status'
+    ('Updated', 'Failed' or 'Skipped') and the 'Error' if it wasn't updated
+    """
+    adminFoodRescuesDF, salesforceRescuesDF, accountsDF, contactDF = getRescuesForComparison(session, rescueFile)
+
+    # only rescues in both the admin site and Salesforce can be updated
+    discrepanciesDF, _ = diffRecords(adminFoodRescuesDF, salesforceRescuesDF, ADMIN_SITE_PRIMARY_KEY, RESCUE_COMPARISON_SCHEMA,
+                                     how='inner', resultNames=('Admin', 'Salesforce'))
+    reportColumns = [ADMIN_SITE_PRIMARY_KEY, 'Id', 'Field', 'Admin', 'Salesforce', 'Status', 'Error']
+    if discrepanciesDF.empty:
+        print('No rescue discrepancies were found!')
+        return pd.DataFrame(columns=reportColumns)
+
+    # one row per changed field of each rescue, a field is changed when either side shows a value
+    adminValues = discrepanciesDF.xs('Admin', axis='columns', level=1)
+    salesforceValues = discrepanciesDF.xs('Salesforce', axis='columns', level=1)
+    changed = (adminValues.notna() | salesforceValues.notna()).stack()
+    reportDF = changed[changed].index.to_frame(index=False, name=[ADMIN_SITE_PRIMARY_KEY, 'Field'])
+    reportDF['Admin'] = adminValues.stack(dropna=False).reindex(pd.MultiIndex.from_frame(reportDF)).to_numpy()
+    reportDF['Salesforce'] = salesforceValues.stack(dropna=False).reindex(pd.MultiIndex.from_frame(reportDF)).to_numpy()
+    reportDF['Status'] = 'Updated'
+    reportDF['Error'] = ''
+
+    # Salesforce Ids of the rescues, rescues with a primary key that isn't unique can't be matched up
+    salesforceIds = salesforceRescuesDF.drop_duplicates(ADMIN_SITE_PRIMARY_KEY, keep=False).set_index(ADMIN_SITE_PRIMARY_KEY)['Id']
+    uniqueAdminRescuesDF = adminFoodRescuesDF.drop_duplicates(ADMIN_SITE_PRIMARY_KEY, keep=False).set_index(ADMIN_SITE_PRIMARY_KEY)
+    reportDF['Id'] = reportDF[ADMIN_SITE_PRIMARY_KEY].map(salesforceIds)
+    ambiguous = reportDF['Id'].isna() | ~reportDF[ADMIN_SITE_PRIMARY_KEY].isin(uniqueAdminRescuesDF.index)
+    reportDF.loc[ambiguous, ['Status', 'Error']] = ['Skipped', 'More than one rescue has this ' + ADMIN_SITE_PRIMARY_KEY]
+
+    # the admin site values to send, in the format Salesforce expects ('#N/A' clears a field)
+    canonicalDF = canonicalizeRecords(uniqueAdminRescuesDF, RESCUE_COMPARISON_SCHEMA)
+    accountsDF = cleanupNameWhitespace(accountsDF, 'Name')
+    contactDF = cleanupNameWhitespace(contactDF, 'Name')
+    nameIndexes = {
+        'Donor_Name': getNameIndex(accountsDF[accountsDF['RecordTypeId'] == getConfigValue('RecordTypeId', 'foodDonor')]),
+        'Partner_Name': getNameIndex(accountsDF[accountsDF['RecordTypeId'] == getConfigValue('RecordTypeId', 'nonProfitPartner')]),
+        'Volunteer_Name': getNameIndex(contactDF[contactDF['AccountId'] == getConfigValue('AccountId', 'volunteers')])
+    }
+    reportDF['Value'] = None
+    for field, kind in RESCUE_COMPARISON_SCHEMA.items():
+        rows = (reportDF['Field'] == field) & (reportDF['Status'] == 'Updated')
+        if not rows.any():
+            continue
+        values = canonicalDF.loc[reportDF.loc[rows, ADMIN_SITE_PRIMARY_KEY], field]
+        blank = (values == '') if kind == 'text' else values.isna()
+        if kind == 'number':
+            values = values.map(lambda value: str(int(value)) if float(value).is_integer() else repr(value), na_action='ignore')
+        elif kind == 'date':
+            values = values.dt.strftime('%Y-%m-%d')
+        elif field in nameIndexes:
+            values = values.map(nameIndexes[field])
+            unknown = values.isna().to_numpy() & ~blank.to_numpy()
+            reportDF.loc[rows[rows].index[unknown], ['Status', 'Error']] = ['Skipped', 'No single Salesforce record has this name']
+        reportDF.loc[rows, 'Value'] = np.where(blank, '#N/A', values.to_numpy(dtype=object))
+
+    # one row per rescue with a column per changed field, fields that aren't changing stay blank
+    toUpdateDF = reportDF[reportDF['Status'] == 'Updated']
+    if toUpdateDF.empty:
+        print('None of the rescue discrepancies could be resolved.')
+        return reportDF[reportColumns]
+    updateDF = toUpdateDF.pivot(index='Id', columns='Field', values='Value')
+    updateDF = updateDF.rename(columns=RESCUE_LOOKUP_FIELD_NAMES).reset_index()
+
+    print('Updating ' + str(len(updateDF)) + ' rescues in Salesforce...')
+    result = salesforce.executeSalesforceIngestJob('update', updateDF.to_csv(index=False), 'Food_Rescue__c', session)
+
+    # every changed field of a rescue that failed failed with it
+    if len(result.failedResults) > 0:
+        errors = result.failedResults.set_index('Id')['sf__Error']
+        failed = reportDF['Id'].isin(errors.index) & (reportDF['Status'] == 'Updated')
+        reportDF.loc[failed, 'Status'] = 'Failed'
+        reportDF.loc[failed, 'Error'] = reportDF.loc[failed, 'Id'].map(errors)
+
+    print(reportDF['Status'].value_counts().to_string())
+    return reportDF[reportColumns]
 
 
 ### WRAPPER FUNCTIONS FOR HELPER TOOLS
-def findDuplicateRecords(df, colName):
-    """generic function to find duplicate records"""
-    duplicatesDF = None
-    try:
-        duplicatesDF = pd.concat(g for _, g in df.groupby(colName) if len(g) > 1)
-    except ValueError:
-        duplicatesDF = 'No duplicates were found!'
+def findDuplicateRecords(df, colName, threshold=None):
+    """generic function to find duplicate records
 
+    By default only records with exactly the same `colName` are returned, sorted by it. If a similarity
+    `threshold` (0 to 1) is given, near duplicates are found too (see findDuplicateClusters) and the
+    records are returned with a 'Cluster Id' column, sorted by cluster
+    """
+    if threshold is None:
+        names = df[colName]
+        # missing and blank names aren't duplicates of each other
+        isNamed = names.notna() & names.astype(str).str.strip().ne('')
+        duplicatesDF = df[names.duplicated(keep=False) & isNamed].sort_values(colName, kind='stable')
+    else:
+        duplicatesDF = df.assign(**{'Cluster Id': findDuplicateClusters(df[colName], threshold)})
+        duplicatesDF = duplicatesDF.dropna(subset=['Cluster Id']).sort_values(['Cluster Id', colName], kind='stable')
+
+    if duplicatesDF.empty:
+        return 'No duplicates were found!'
     return duplicatesDF
 
-def findDuplicateFoodDonors(accountsDF):
-    """wrapper function that returns duplicate Food Donor Accounts in Salesforce"""
+def findDuplicateClusters(names, threshold=None, window=DUPLICATE_WINDOW):
+    """helper function that groups names that are the same or nearly the same, returns a Series of cluster ids
+
+    Names are blocked on their normalized form (casefolded, no punctuation, single spaces), so
+    "Giant Eagle #12" and "giant eagle  12" always end up in the same cluster. The distinct normalized
+    names are then sorted, once as they are and once with their words sorted, and each one is only
+    compared with the next `window` names (sorted neighbourhood). Two names are joined when their
+    difflib similarity is at least `threshold` and they contain the same numbers, so "Giant Eagle #12"
+    and "Giant Eagle #13" stay apart. Names that don't share a cluster with another row get <NA>, and so do
+    missing names and names that are blank once normalized. `threshold` defaults to duplicateSimilarityThreshold
+    in config.ini.
+    """
+    if threshold is None:
+        threshold = CONFIG.getFloat('GeneralConfiguration', 'duplicateSimilarityThreshold')
+    keys = normalizeNames(names.dropna(), casefold=True, unicodeForm='NFKC', stripPunctuation=True)
+    keys = keys[keys != '']
+    codes, uniqueKeys = pd.factorize(keys)
+    uniqueKeys = list(uniqueKeys)
+    numbers = [re.findall(r'\d+', key) for key in uniqueKeys]
+
+    # union-find over the distinct normalized names
+    parents = list(range(len(uniqueKeys)))
+
+    def findRoot(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for sortKeys in (uniqueKeys, [' '.join(sorted(key.split())) for key in uniqueKeys]):
+        order = sorted(range(len(sortKeys)), key=sortKeys.__getitem__)
+        for position, i in enumerate(order):
+            matcher = None
+            for j in order[position + 1:position + 1 + window]:
+                rootI, rootJ = findRoot(i), findRoot(j)
+                if rootI == rootJ or numbers[i] != numbers[j]:
+                    continue
+                # difflib caches what it learns about the second sequence, so that one stays fixed
+                if matcher is None:
+                    matcher = difflib.SequenceMatcher(None, b=sortKeys[i], autojunk=False)
+                matcher.set_seq1(sortKeys[j])
+                # the cheap upper bounds rule out most pairs before the full comparison
+                if (matcher.real_quick_ratio() >= threshold and matcher.quick_ratio() >= threshold
+                        and matcher.ratio() >= threshold):
+                    parents[rootJ] = rootI
+
+    # only keep clusters with more than one row, numbered in order of their first name
+    roots = pd.Series(np.array([findRoot(i) for i in range(len(uniqueKeys))], dtype=np.int64)[codes], index=keys.index)
+    inCluster = roots.duplicated(keep=False)
+    clusterRoots = roots[inCluster].iloc[np.argsort(keys[inCluster].to_numpy(), kind='stable')]
+    clusterIds = pd.Series(pd.factorize(clusterRoots)[0] + 1, index=clusterRoots.index)
+
+    return clusterIds.reindex(names.index).astype('Int64').rename('Cluster Id')
+
+def findDuplicateFoodDonors(accountsDF, threshold=None):
+    """wrapper function that returns duplicate Food Donor Accounts in Salesforce
+
+    `accountsDF` can also be a mirror.SalesforceMirror, which finds exact duplicates with its indexes.
+    Pass a similarity `threshold` to find near duplicates too (see findDuplicateRecords)
+    """
+    if isinstance(accountsDF, mirror.SalesforceMirror):
+        if threshold is None:
+            return findDuplicateRecords(accountsDF.findDuplicateRecords('Account', 'Name', 'RecordTypeId', getConfigValue('RecordTypeId', 'foodDonor')), 'Name')
+        accountsDF = accountsDF.getDataframe('SELECT Id, Name, RecordTypeId FROM Account')
+
     # filter all Accounts to just get Food Donors (id: '0123t000000YYv2AAG')
     foodDonorsDF = accountsDF[accountsDF['RecordTypeId'] == getConfigValue('RecordTypeId', 'foodDonor')]
 
-    return findDuplicateRecords(foodDonorsDF, 'Name')
+    return findDuplicateRecords(foodDonorsDF, 'Name', threshold)
+
+def findDuplicateNonprofitPartners(accountsDF, threshold=None):
+    """wrapper function that returns duplicate Nonprofit Partner Accounts in Salesforce
+
+    `accountsDF` can also be a mirror.SalesforceMirror, which finds exact duplicates with its indexes.
+    Pass a similarity `threshold` to find near duplicates too (see findDuplicateRecords)
+    """
+    if isinstance(accountsDF, mirror.SalesforceMirror):
+        if threshold is None:
+            return findDuplicateRecords(accountsDF.findDuplicateRecords('Account', 'Name', 'RecordTypeId', getConfigValue('RecordTypeId', 'nonProfitPartner')), 'Name')
+        accountsDF = accountsDF.getDataframe('SELECT Id, Name, RecordTypeId FROM Account')
 
-def findDuplicateNonprofitPartners(accountsDF,):
-    """wrapper function that returns duplicate Nonprofit Partner Accounts in Salesforce"""
     # filter all Accounts to just get Nonprofit Partners (id: '0123t000000YYv3AAG')
     nonprofitPartnersDF = accountsDF[accountsDF['RecordTypeId'] == getConfigValue('RecordTypeId', 'nonProfitPartner')]
 
-    return findDuplicateRecords(nonprofitPartnersDF, 'Name')
+    return findDuplicateRecords(nonprofitPartnersDF, 'Name', threshold)
+
+def findDuplicateVolunteers(contactsDF, threshold=None):
+    """wrapper function that returns duplicate Volunteer Contacts in Salesforce
+
+    `contactsDF` can also be a mirror.SalesforceMirror, which finds exact duplicates with its indexes.
+    Pass a similarity `threshold` to find near duplicates too (see findDuplicateRecords)
+    """
+    if isinstance(contactsDF, mirror.SalesforceMirror):
+        if threshold is None:
+            return findDuplicateRecords(contactsDF.findDuplicateRecords('Contact', 'Name', 'AccountId', getConfigValue('AccountId', 'volunteers')), 'Name')
+        contactsDF = contactsDF.getDataframe('SELECT Id, Name, AccountId FROM Contact')
 
-def findDuplicateVolunteers(contactsDF):
-    """wrapper function that returns duplicate Volunteer Contacts in Salesforce"""
     # filter all Contacts to just get Food Rescue Heroes (id: '0013t00001teMBwAAM')
     volunteersDF = contactsDF[contactsDF['AccountId'] == getConfigValue('AccountId', 'volunteers')]
 
-    return findDuplicateRecords(volunteersDF, 'Name')
+    return findDuplicateRecords(volunteersDF, 'Name', threshold)
+
+def findIncompleteRescues(rescueFile, startDate=None, endDate=None):
+    """function to find old rescues that haven't been marked as completed or canceled
+
+    If `startDate` or `endDate` are given (dates or 'YYYY-MM-DD' strings, both inclusive),
+    only rescues picked up within that range are checked
+    """
+    # only read in the columns that are returned
+    columns = ['Rescue ID', 'Day of Pickup Start', 'Rescue State', 'Rescue Detail URL']
+    rescuesDF = loadAdminExport(rescueFile, 'rescues', columns)
+
+    # filter out completed and canceled rescues before parsing any dates
+    rescuesDF = rescuesDF[~rescuesDF['Rescue State'].isin(['completed', 'canceled'])]
 
-def findIncompleteRescues(rescueFile):
-    """function to find old rescues that haven't been marked as completed or canceled"""
-    # filter out completed and canceled rescues
-    rescuesDF = pd.read_csv(rescueFile)
-    rescuesDF = rescuesDF[(rescuesDF['Rescue State'] != 'completed') & (rescuesDF['Rescue State'] != 'canceled')]
-    rescuesDF = rescuesDF.reset_index().drop(axis='columns', columns=['index'])
+    # convert date strings to dates for comparison, all at once
+    pickupDates = pd.to_datetime(rescuesDF['Day of Pickup Start'], format='%Y-%m-%d')
 
-    # convert date strings to date objects for comparison
-    for index, _ in rescuesDF.iterrows():
-        rescuesDF.at[index, 'Day of Pickup Start'] = datetime.datetime.strptime(rescuesDF.at[index, 'Day of Pickup Start'], '%Y-%m-%d').date()
+    # keep rescues before today (and within the date range) that haven't been completed or canceled
+    keep = pickupDates < pd.Timestamp(datetime.date.today())
+    if startDate is not None:
+        keep &= pickupDates >= pd.Timestamp(startDate)
+    if endDate is not None:
+        keep &= pickupDates <= pd.Timestamp(endDate)
 
-    # return rescues before today that haven't been completed or canceled
-    today = datetime.date.today()
-    rescuesDF = rescuesDF[rescuesDF['Day of Pickup Start'] < today]
-    return rescuesDF[['Rescue ID', 'Day of Pickup Start', 'Rescue State', 'Rescue Detail URL']].drop_duplicates().reset_index().drop(axis='columns', columns=['index'])
+    rescuesDF = rescuesDF[keep].assign(**{'Day of Pickup Start': pickupDates[keep].dt.date})
+    return rescuesDF[columns].drop_duplicates().reset_index(drop=True)
 
 def updateSFRescuesWithComments(session, rescueCommentFile):
     """function to update Salesforce rescues with comments from an excel file"""
     # get rescues from Salesforce
-    salesforceRescuesDF = salesforce.getDataframeFromSalesforce('SELECT Id, Rescue_Id__c, Comments__c FROM Food_Rescue__c', session)
+    salesforceRescuesDF = salesforce.getSyncedDataframe('Food_Rescue__c', ['Id', 'Rescue_Id__c', 'Comments__c'], session)
     salesforceRescuesDF.columns = ['Id', 'Rescue ID', 'Comments']
 
     # create rescues DF from comments CSV file
-    commentsDF = pd.read_csv(rescueCommentFile)
-    commentsDF = commentsDF[['Rescue ID', 'Comments']]
+    commentsDF = loadAdminExport(rescueCommentFile, 'comments')
 
     # filter out rescues that already have associated comments
     salesforceRescuesDF = salesforceRescuesDF.loc[salesforceRescuesDF.Comments.isnull()]
@@ -367,41 +663,53 @@ def findRescueDiscrepancies(session, choice, rescueFile):
     Choice can be two options:
         If choice is `1`, then rescue IDs that are marked completed in Salesforce but not in the admin tool are identified
         If choice is `2`, then rescue IDs that are marked completed in the admin tool but not in Salesforce are identified
-    """
-    salesforceRescuesDF = salesforce.getDataframeFromSalesforce('SELECT State__c, Food_Type__c, Day_of_Pickup__c, Rescue_Detail_URL__c, Rescue_Id__c FROM Food_Rescue__c', session)
-    salesforceRescuesDF['Day_of_Pickup__c'] = pd.to_datetime(salesforceRescuesDF['Day_of_Pickup__c'])
-
-    # only completed rescues
-    salesforceRescuesDF = salesforceRescuesDF[salesforceRescuesDF['State__c'] == 'completed']
-
-    # sort by Rescue ID
-    salesforceRescuesDF = salesforceRescuesDF.sort_values(by='Rescue_Id__c')
-
-    adminRescuesDF = pd.read_csv(rescueFile)
-    adminRescuesDF['Day of Pickup Start'] = pd.to_datetime(adminRescuesDF['Day of Pickup Start'])
-
-    # only completed rescues
-    adminRescuesDF = adminRescuesDF[adminRescuesDF['Rescue State'] == 'completed']
-
-    # sort by Rescue ID
-    adminRescuesDF = adminRescuesDF.sort_values(by='Rescue ID')
 
-    adminRescueID = adminRescuesDF['Rescue ID']
-    salesforceRescueID = salesforceRescuesDF['Rescue_Id__c']
+    Use findAllRescueDiscrepancies to get both (and the rescues in both) at once
+    """
+    notInAdmin, notInSalesforce, _ = findAllRescueDiscrepancies(session, rescueFile)
 
     if choice == 1:
         # print all rescue IDs in Salesforce but not in admin
-        res = salesforceRescueID[~salesforceRescueID.isin(adminRescueID)]
+        res = notInAdmin
         print('All rescue IDs that are marked completed in Salesforce but not in the admin tool:')
     elif choice == 2:
         # print all rescue IDs in the admin tool but not in Salesforce
-        res = adminRescueID[~adminRescueID.isin(salesforceRescueID)]
+        res = notInSalesforce
         print('All rescue IDs that are marked completed in the admin tool but not in Salesforce:')
 
     print('Record Count:')
     print(res.count())
     return res
 
+def findAllRescueDiscrepancies(session, rescueFile):
+    """function to find the completed food rescues that are only in Salesforce, only in the admin tool, or in both
+
+    Returns three Series of rescue IDs, in the order they appear in their source:
+        the IDs marked completed in Salesforce but not in the admin tool,
+        the IDs marked completed in the admin tool but not in Salesforce,
+        and the IDs marked completed in both
+    """
+    salesforceRescuesDF = salesforce.getSyncedDataframe('Food_Rescue__c', ['State__c', 'Food_Type__c', 'Day_of_Pickup__c', 'Rescue_Detail_URL__c', 'Rescue_Id__c'], session)
+    adminRescuesDF = loadAdminExport(rescueFile, 'rescues', ['Rescue ID', 'Rescue State'])
+
+    # only completed rescues
+    salesforceRescueID = salesforceRescuesDF.loc[salesforceRescuesDF['State__c'] == 'completed', 'Rescue_Id__c']
+    adminRescueID = adminRescuesDF.loc[adminRescuesDF['Rescue State'] == 'completed', 'Rescue ID']
+
+    # hash both sides' IDs together once, then mark which side each distinct ID was seen on
+    codes, uniques = pd.factorize(np.concatenate([salesforceRescueID.to_numpy(dtype=object), adminRescueID.to_numpy(dtype=object)]))
+    salesforceCodes, adminCodes = codes[:len(salesforceRescueID)], codes[len(salesforceRescueID):]
+    inSalesforce = np.zeros(len(uniques) + 1, dtype=bool)
+    inAdmin = np.zeros(len(uniques) + 1, dtype=bool)
+    # blank IDs get code -1, which lands on the extra last slot
+    inSalesforce[salesforceCodes] = True
+    inAdmin[adminCodes] = True
+
+    notInAdmin = salesforceRescueID[~inAdmin[salesforceCodes]]
+    notInSalesforce = adminRescueID[~inSalesforce[adminCodes]]
+    inBoth = adminRescueID[inSalesforce[adminCodes]]
+    return notInAdmin, notInSalesforce, inBoth
+
 def compareAdminAndSalesforceRescues(session, rescueFile, onlyCompareRecordsWithPrimaryKey=1,howToShowResults = 1):
     """Function that compares the FoodRescueHero (admin site) rescues that are downloaded
     with the ones already in Salesforce. Results are returned.
@@ -419,154 +727,422 @@ def compareAdminAndSalesforceRescues(session, rescueFile, onlyCompareRecordsWith
             * If `howToShowResults` is `1`, then the differences are shown the same line, side by side with eachother
             * If `howToShowResults` is `2`, then the differences are show on different lines, stacked on top of eachother
     """
-    # Constants to be used throughout
-    # Used Right now as place holders
-    ADMIN_SITE_PRIMARY_KEY = 'Food Rescue Primary Key'
-    SALESFORCE_SITE_PRIMARY_KEY = 'Food_Rescue_Id__c'
+    adminFoodRescuesDF, salesforceRescuesDF, _, _ = getRescuesForComparison(session, rescueFile)
 
-    # Admin Site Rescue File
-    adminFoodRescuesDF = pd.read_csv(rescueFile)
+    if onlyCompareRecordsWithPrimaryKey == 1:
+        joinType = 'inner'
+    elif onlyCompareRecordsWithPrimaryKey == 2:
+        joinType = 'outer'
+    else:
+        print("Incorrect Value for `onlyCompareRecordsWithPrimaryKey`. Assuming option 1: `Iner Join`")
+        joinType = 'inner'
 
-    # Salesforce DataFrames
-    salesforceRescuesDF = salesforce.getDataframeFromSalesforce(f'SELECT Id, Rescue_Id__c, {SALESFORCE_SITE_PRIMARY_KEY}, State__c, Day_of_Pickup__c, Description__c, Food_Type__c, Weight__c, Rescue_Detail_URL__c, Food_Donor_Account_Name__c, Agency_Name__c, Volunteer_Name__c FROM Food_Rescue__c', session)
-    accountsDF = salesforce.getDataframeFromSalesforce('SELECT Id, Name, RecordTypeId FROM Account', session)
-    contactDF = salesforce.getDataframeFromSalesforce('SELECT Id, Name, AccountId FROM Contact', session)
+    if howToShowResults == 1:
+        # In-line comparison
+        alignAxis = 1
+    elif howToShowResults == 2:
+        # Stacked Comparisons
+        alignAxis = 0
+    else:
+        print("Choice is not a valid option. Assuming In-line comparison is preferred")
+        alignAxis = 1
 
-    # Filters DataFrames down to only have the correct information
-    foodDonorsDF = accountsDF[accountsDF['RecordTypeId'] == getConfigValue('RecordTypeId', 'foodDonor')]
-    partnerDF = accountsDF[accountsDF['RecordTypeId'] == getConfigValue('RecordTypeId', 'nonProfitPartner')]
-    volunteerDF = contactDF[contactDF['AccountId'] == getConfigValue('AccountId', 'volunteers')]
+    comparisonDF, fieldCounts = diffRecords(adminFoodRescuesDF, salesforceRescuesDF, ADMIN_SITE_PRIMARY_KEY, RESCUE_COMPARISON_SCHEMA,
+                                            how=joinType, resultNames=('Admin', 'Salesforce'), alignAxis=alignAxis)
 
-    # Renames and removes uneeded columns in joined tables
-    foodDonorsDF = accountsDF[['Id', 'Name']]
-    foodDonorsDF = foodDonorsDF.rename(
-        columns={
-            'Id': 'Donor_Id',
-            'Name': 'Donor_Name'
-        }
-    )
+    print('Rescues with differences per field:')
+    print(fieldCounts.to_string())
 
-    partnerDF = accountsDF[['Id', 'Name']]
-    partnerDF = partnerDF.rename(
-        columns={
-            'Id': 'Partner_Id',
-            'Name': 'Partner_Name'
-        }
-    )
+    return comparisonDF
 
-    volunteerDF = contactDF[['Id', 'Name']]
-    volunteerDF = volunteerDF.rename(
-        columns={
-            'Id': 'Volunteer_Id',
-            'Name': 'Volunteer_Name'
-        }
-    )
+### GENERAL HELPERS
+def runStages(stages):
+    """
+    helper function that runs a small graph of stages, starting each one as soon as the stages it depends on are done
 
-    # Merges additional dataframes from SalesForce to get all data that can be compared
-    salesforceRescuesDF = salesforceRescuesDF.merge(
-        foodDonorsDF, how='left', left_on='Food_Donor_Account_Name__c', right_on='Donor_Id')
-    salesforceRescuesDF = salesforceRescuesDF.merge(
-        partnerDF, how='left', left_on='Agency_Name__c', right_on='Partner_Id')
-    salesforceRescuesDF = salesforceRescuesDF.merge(
-        volunteerDF, how='left', left_on='Volunteer_Name__c', right_on='Volunteer_Id')
+    `stages` maps each stage's name to a (function, names of the stages it depends on) tuple. Stages that
+    don't depend on each other run at the same time. If a stage fails the stages that depend on it are
+    skipped, and the first error is raised once the other stages are done. Inside salesforce.checkpointedRun,
+    stages that finished in an earlier attempt of the run are skipped.
 
-    salesforceRescuesDF.drop(['Donor_Id','Partner_Id','Volunteer_Id'], axis=1, inplace=True)
+    Prints and returns a timeline with each stage's status and when it started and ended (in seconds from the start)
+    """
+    for name, (_, dependencies) in stages.items():
+        unknownStages = [dependency for dependency in dependencies if dependency not in stages]
+        if len(unknownStages) > 0:
+            raise ValueError(f'Stage {name} depends on unknown stage(s) {", ".join(unknownStages)}')
+
+    startTime = time.perf_counter()
+    times = {}
+    statuses = {}
+    errors = []
+    # in a checkpointed run (see salesforce.checkpointedRun) stages finished by an earlier attempt aren't run again
+    journal = salesforce.getCheckpointJournal()
+    resumedStages = set()
+
+    def runStage(name, function):
+        stageStart = time.perf_counter()
+        print(name + ' started.')
+        try:
+            function()
+            if journal is not None:
+                journal.record(event='stage', stage=name)
+        finally:
+            times[name] = (stageStart - startTime, time.perf_counter() - startTime)
+            print(name + ' finished.')
+
+    pending = dict(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(len(stages), 1)) as executor:
+        while pending or running:
+            # start every stage whose dependencies are done, and skip the ones whose dependencies failed
+            for name, (function, dependencies) in list(pending.items()):
+                dependencyStatuses = [statuses.get(dependency) for dependency in dependencies]
+                if any(status in ('Failed', 'Skipped') for status in dependencyStatuses):
+                    statuses[name] = 'Skipped'
+                    del pending[name]
+                elif all(status == 'Done' for status in dependencyStatuses):
+                    if journal is not None and journal.isStageDone(name):
+                        print(name + ' already finished in an earlier attempt, skipping it.')
+                        statuses[name] = 'Done'
+                        resumedStages.add(name)
+                    else:
+                        running[executor.submit(runStage, name, function)] = name
+                    del pending[name]
+
+            if not running:
+                if pending:
+                    raise ValueError('These stages depend on each other in a cycle: ' + ', '.join(pending))
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is None:
+                    statuses[name] = 'Done'
+                else:
+                    statuses[name] = 'Failed'
+                    errors.append(future.exception())
+
+    timelineDF = pd.DataFrame({
+        'Stage': list(stages),
+        'Status': [statuses[name] + (' (earlier attempt)' if name in resumedStages else '') for name in stages],
+        'Start': [times.get(name, (np.nan, np.nan))[0] for name in stages],
+        'End': [times.get(name, (np.nan, np.nan))[1] for name in stages]
+    })
+    timelineDF['Seconds'] = timelineDF['End'] - timelineDF['Start']
+    print('\nStage timeline (seconds from the start):')
+    print(timelineDF.round(1).to_string(index=False))
+    print('Total: ' + str(round(time.perf_counter() - startTime, 1)) + ' seconds')
+
+    if errors:
+        raise errors[0]
+    return timelineDF
+
+def getRescuesForComparison(session, rescueFile):
+    """helper function that returns the admin site rescues and the Salesforce rescues ready to be compared,
+    together with the Salesforce Accounts and Contacts
+
+    Both rescue Dataframes have the RESCUE_COMPARISON_SCHEMA columns and the ADMIN_SITE_PRIMARY_KEY column,
+    the Salesforce one also has the rescue's Id and the donor, partner and volunteer Ids. Donors and partners
+    are compared by location name (the accounts rescues link to), all names with their whitespace cleaned up
+    """
+    # Admin Site Rescue File
+    adminFoodRescuesDF = loadAdminExport(rescueFile, 'rescues', [ADMIN_SITE_PRIMARY_KEY, 'Rescue ID', 'Food Type', 'Description', 'Day of Pickup Start',
+                                                                 'Donor Location Name', 'Recipient Location Name', 'Volunteer Name', 'Rescue State', 'Weight', 'Rescue Detail URL'])
 
-    if onlyCompareRecordsWithPrimaryKey == 1:
-        joinType = 'inner'
-    elif onlyCompareRecordsWithPrimaryKey == 2:
-        joinType = 'outer'
-    else:
-        print("Incorrect Value for `onlyCompareRecordsWithPrimaryKey`. Assuming option 1: `Iner Join`")
-        joinType = 'inner'
+    # Salesforce DataFrames
+    # bring the local rescue snapshot up to date while Accounts and Contacts are being queried
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        rescuesFuture = executor.submit(salesforce.getSyncedDataframe, 'Food_Rescue__c',
+            ['Id', 'Rescue_Id__c', SALESFORCE_SITE_PRIMARY_KEY, 'State__c', 'Day_of_Pickup__c', 'Description__c', 'Food_Type__c', 'Weight__c', 'Rescue_Detail_URL__c', 'Food_Donor_Account_Name__c', 'Agency_Name__c', 'Volunteer_Name__c'], session)
+        dataframes = salesforce.getDataframesFromSalesforce({
+            'accounts': 'SELECT Id, Name, RecordTypeId FROM Account',
+            'contacts': 'SELECT Id, Name, AccountId FROM Contact'
+        }, session)
+        salesforceRescuesDF = rescuesFuture.result()
+    accountsDF = dataframes['accounts']
+    contactDF = dataframes['contacts']
+
+    # Salesforce stores Ids for the donor, partner and volunteer, look up their names to compare with the admin site
+    # rescues link to the donor and partner location accounts, as in uploadFoodRescues
+    accountNames = cleanupNameWhitespace(accountsDF, 'Name').set_index('Id')['Name']
+    contactNames = cleanupNameWhitespace(contactDF, 'Name').set_index('Id')['Name']
+    salesforceRescuesDF = salesforceRescuesDF.assign(
+        Donor_Name=salesforceRescuesDF['Food_Donor_Account_Name__c'].map(accountNames),
+        Partner_Name=salesforceRescuesDF['Agency_Name__c'].map(accountNames),
+        Volunteer_Name=salesforceRescuesDF['Volunteer_Name__c'].map(contactNames)
+    )
 
-    # Full outer joins the Pandas Dataframe
-    df = pd.merge(adminFoodRescuesDF, salesforceRescuesDF, how=joinType, left_on=[ADMIN_SITE_PRIMARY_KEY], right_on=[SALESFORCE_SITE_PRIMARY_KEY])
-
-    df.set_index(ADMIN_SITE_PRIMARY_KEY, inplace=True)
-
-    # Converts all blanks to empty strings for comparison
-    df['Day of Pickup Start'].fillna('', inplace=True)
-    df['Day_of_Pickup__c'].fillna('', inplace=True)
-    df['Donor Name'].fillna('', inplace=True)
-    df['Food_Donor_Account_Name__c'].fillna('', inplace=True)
-    df['Recipient Name'].fillna('', inplace=True)
-    df['Agency_Name__c'].fillna('', inplace=True)
-    df['Volunteer Name'].fillna('', inplace=True)
-    df['Volunteer_Name__c'].fillna('', inplace=True)
-    df['Rescue State'].fillna('', inplace=True)
-    df['State__c'].fillna('', inplace=True)
-    df['Weight'].fillna('', inplace=True)
-    df['Weight__c'].fillna('', inplace=True)
-    df['Rescue Detail URL'].fillna('', inplace=True)
-    df['Rescue_Detail_URL__c'].fillna('', inplace=True)
-
-    # Formats all DateTime Columns the same
-    dateColumns = ['Day of Pickup Start','Day_of_Pickup__c']
-
-    for column in dateColumns:
-        df[column] = pd.to_datetime(df[column])
-        df[column] = df[column].dt.strftime('%m/%d/%Y')
-
-    # Filters Dataframe down to only where there are differences
-    filtered = df[
-        (df['Day of Pickup Start'] != df['Day_of_Pickup__c']) |
-        (df['Donor Name'] != df['Food_Donor_Account_Name__c']) |
-        (df['Recipient Name'] != df['Agency_Name__c']) |
-        (df['Volunteer Name'] != df['Volunteer_Name__c']) |
-        (df['Rescue State'] != df['State__c']) |
-        (df['Weight'] != df['Weight__c']) |
-        (df['Rescue Detail URL'] != df['Rescue_Detail_URL__c'])
-    ]
-
-
-    # Splits full outer join apart to be able to run a pd.Compare
-    adminFoodRescuesDF = filtered[['Rescue ID','Food Type','Description','Day of Pickup Start', 'Donor Name', 'Recipient Name','Volunteer Name', 'Rescue State', 'Weight', 'Rescue Detail URL']]
-    salesforceRescuesDF = filtered[['Rescue_Id__c','Food_Type__c','Description__c','Day_of_Pickup__c', 'Donor_Name','Partner_Name', 'Volunteer_Name', 'State__c', 'Weight__c', 'Rescue_Detail_URL__c']]
-
-    # Renames Food Rescue Dataframe columns to match what is in salesforce
+    # Renames the admin site columns to match what is in salesforce
     adminFoodRescuesDF = adminFoodRescuesDF.rename(
         columns={
             'Rescue ID': 'Rescue_Id__c',
             'Food Type': 'Food_Type__c',
             'Description': 'Description__c',
             'Day of Pickup Start': 'Day_of_Pickup__c',
-            'Donor Name': 'Donor_Name',
-            'Recipient Name': 'Partner_Name',
+            'Donor Location Name': 'Donor_Name',
+            'Recipient Location Name': 'Partner_Name',
             'Volunteer Name': 'Volunteer_Name',
             'Rescue State': 'State__c',
             'Weight': 'Weight__c',
             'Rescue Detail URL': 'Rescue_Detail_URL__c'
         }
     )
+    # names are matched with their whitespace cleaned up, as in uploadFoodRescues, blanks stay blank
+    for nameField in RESCUE_LOOKUP_FIELD_NAMES:
+        adminNames = adminFoodRescuesDF[nameField]
+        adminFoodRescuesDF[nameField] = normalizeNames(adminNames).where(adminNames.notna())
+    salesforceRescuesDF = salesforceRescuesDF.rename(columns={SALESFORCE_SITE_PRIMARY_KEY: ADMIN_SITE_PRIMARY_KEY})
 
-    if howToShowResults == 1:
-        # In-line comparison
-        comparisonDF = adminFoodRescuesDF.compare(salesforceRescuesDF, align_axis=1, result_names=('Admin', 'Salesforce'))
-    elif howToShowResults == 2:
-        # Stacked Comparisons
-        comparisonDF = adminFoodRescuesDF.compare(salesforceRescuesDF, align_axis=0, result_names=('Admin', 'Salesforce'))
+    return adminFoodRescuesDF, salesforceRescuesDF, accountsDF, contactDF
+
+
+def diffRecords(leftDF, rightDF, key, schema, how='inner', resultNames=('Left', 'Right'), alignAxis=1):
+    """
+    generic function that compares two sets of records field by field and returns only what is different
+
+    Both Dataframes need a `key` column the records are matched on and the `schema` columns, where
+    `schema` maps each compared column to how it is compared: 'text', 'number' or 'date'
+    (e.g. {'Name': 'text', 'Phone': 'number'} for Accounts). `how` is the merge type used to match
+    the records, records missing from one side are compared against blanks.
+
+    Both sides are put in a canonical form once and every record gets a fingerprint (a hash over its
+    compared fields), so only the records whose fingerprints differ are compared field by field.
+
+    Returns the differences in the format of DataFrame.compare (indexed by `key`, only the changed
+    records and fields) and a Series with how many records are different in each field
+    """
+    fields = list(schema)
+    left = canonicalizeRecords(leftDF, schema).reset_index(drop=True)
+    right = canonicalizeRecords(rightDF, schema).reset_index(drop=True)
+
+    # match the records up by key using only their fingerprints and row numbers
+    pairsDF = pd.merge(
+        pd.DataFrame({key: leftDF[key].to_numpy(), 'leftRow': left.index, 'leftHash': pd.util.hash_pandas_object(left, index=False).to_numpy()}),
+        pd.DataFrame({key: rightDF[key].to_numpy(), 'rightRow': right.index, 'rightHash': pd.util.hash_pandas_object(right, index=False).to_numpy()}),
+        how=how, on=key
+    )
+    pairsDF = pairsDF[pairsDF['leftHash'] != pairsDF['rightHash']]
+
+    # a blank record at the end of each side stands in for records that are missing from it
+    left = pd.concat([left, canonicalizeRecords(pd.DataFrame(columns=fields, index=[0]), schema)], ignore_index=True)
+    right = pd.concat([right, canonicalizeRecords(pd.DataFrame(columns=fields, index=[0]), schema)], ignore_index=True)
+    leftChanged = left.take(pairsDF['leftRow'].fillna(-1).astype(np.int64).to_numpy())
+    rightChanged = right.take(pairsDF['rightRow'].fillna(-1).astype(np.int64).to_numpy())
+    leftChanged.index = rightChanged.index = pd.Index(pairsDF[key], name=key)
+
+    # dates are shown the same way for both sides
+    for field in fields:
+        if schema[field] == 'date':
+            leftChanged[field] = leftChanged[field].dt.strftime('%m/%d/%Y')
+            rightChanged[field] = rightChanged[field].dt.strftime('%m/%d/%Y')
+
+    different = leftChanged.ne(rightChanged) & ~(leftChanged.isna() & rightChanged.isna())
+    fieldCounts = different.sum().rename('Records')
+    comparisonDF = leftChanged.compare(rightChanged, align_axis=alignAxis, result_names=resultNames)
+
+    return comparisonDF, fieldCounts
+
+def canonicalizeRecords(df, schema):
+    """helper function that returns the `schema` columns of `df` in a form that can be compared and hashed
+
+    'text' becomes strings with blanks as '', 'number' becomes floats and 'date' becomes dates (without a time)
+    """
+    canonicalDF = pd.DataFrame(index=df.index)
+    for field, kind in schema.items():
+        values = df[field]
+        if kind == 'text':
+            # only the distinct values are converted
+            codes, uniques = pd.factorize(values)
+            strings = np.array([str(value) for value in uniques] + [''], dtype=object)
+            canonicalDF[field] = strings[codes]
+        elif kind == 'number':
+            canonicalDF[field] = pd.to_numeric(values, errors='coerce').astype(np.float64)
+        elif kind == 'date':
+            values = pd.to_datetime(values, errors='coerce')
+            if values.dt.tz is not None:
+                values = values.dt.tz_convert(None)
+            canonicalDF[field] = values.dt.normalize()
+        else:
+            raise ValueError(f'Unknown comparison type {kind} for {field}, use text, number or date')
+    return canonicalDF
+
+def getIdsByName(recordsDF, names):
+    """helper function that returns a Series indexed by name of the Ids of the records in `recordsDF` with those `names`
+
+    Raises a ValueError if any of the names belongs to more than one record, since the right Id can't be picked
+    """
+    recordsDF = recordsDF[recordsDF['Name'].isin(names)]
+    duplicateNames = recordsDF.loc[recordsDF['Name'].duplicated(), 'Name'].unique()
+    if len(duplicateNames) > 0:
+        raise ValueError('These names belong to more than one record in Salesforce, please merge or rename them first: ' + ', '.join(duplicateNames))
+    return pd.Series(recordsDF['Id'].to_numpy(), index=recordsDF['Name'].to_numpy())
+
+def loadAdminExport(path, report, columns=None):
+    """helper function that reads an admin tool export, only loading the columns of its `report` schema
+    ('donors', 'partners', 'volunteers', 'rescues' or 'comments', see ADMIN_EXPORT_SCHEMAS) with their dtypes
+
+    `columns` narrows the schema down further. The header is checked before anything else is read,
+    a ValueError listing the missing columns is raised if the export doesn't match the schema
+    """
+    schema = ADMIN_EXPORT_SCHEMAS[report]
+    if columns is None:
+        columns = list(schema)
+        required = [column for column in columns if column not in ADMIN_EXPORT_OPTIONAL_COLUMNS]
     else:
-        print("Choice is not a valid option. Assuming In-line comparison is preferred")
-        comparisonDF = adminFoodRescuesDF.compare(salesforceRescuesDF, align_axis=1, result_names=('Admin', 'Salesforce'))
+        required = list(columns)
 
-    return comparisonDF
+    header = pd.read_csv(path, nrows=0).columns
+    missingColumns = [column for column in required if column not in header]
+    if len(missingColumns) > 0:
+        raise ValueError(f'{path} is missing the column(s) {", ".join(missingColumns)}, is it the {report} export from the admin tool?')
+
+    columns = [column for column in columns if column in header]
+    dtypes = {column: schema[column] for column in columns if schema[column] is not None}
+    return pd.read_csv(path, usecols=columns, dtype=dtypes)[columns]
+
+def getNameIndex(recordsDF):
+    """helper function that returns a Series of the Ids in `recordsDF` indexed by name, leaving out names that belong to more than one record"""
+    recordsDF = recordsDF.drop_duplicates('Name', keep=False)
+    return pd.Series(recordsDF['Id'].to_numpy(), index=recordsDF['Name'].to_numpy())
 
-### GENERAL HELPERS
 def cleanupNameWhitespace(df, colName):
-    """helper function to cleanup whitespace between words in a DF column"""
-    for index, _row in df.iterrows():
-        df.at[index, colName] = ' '.join(str(df.at[index, colName]).split())
+    """helper function to cleanup whitespace between words in a DF column
+
+    Returns a new Dataframe that shares the other columns with `df`, `df` itself is left unchanged
+    """
+    df = df.copy(deep=False)
+    df[colName] = normalizeNames(df[colName])
     return df
 
+def normalizeNames(names, casefold=False, unicodeForm=None, stripPunctuation=False):
+    """helper function that cleans up a whole column of names at once and returns them as a new Series
+
+    Whitespace between words is always collapsed to single spaces. Optionally the names are also
+    normalized to a unicode form (e.g. 'NFKC'), casefolded, and stripped of punctuation.
+    Each distinct name is only cleaned once, no matter how many rows it appears in.
+    """
+    # clean the distinct values and map them back onto the rows (blanks become 'nan' like str() does)
+    # plain comprehensions over the distinct values are quicker than the .str accessor on object columns
+    codes, uniques = pd.factorize(names, use_na_sentinel=False)
+    cleaned = [str(name) for name in uniques]
+
+    if unicodeForm is not None:
+        cleaned = [unicodedata.normalize(unicodeForm, name) for name in cleaned]
+    if casefold:
+        cleaned = [name.casefold() for name in cleaned]
+    if stripPunctuation:
+        cleaned = [PUNCTUATION_PATTERN.sub(' ', name) for name in cleaned]
+    cleaned = np.array([' '.join(name.split()) for name in cleaned], dtype=object)
+
+    return pd.Series(cleaned[codes], index=names.index, name=names.name)
+
 def getConfigValue(section, key):
-    """Gets the value for the section and key within config.ini"""
-    configurationFile = "config.ini"
-    config = configparser.ConfigParser()
-    config.read(configurationFile)
-    try:
-        configValue = config[section][key]
-    except KeyError as exc:
-        raise KeyError(f'Unable to find {key} in {section} within {configurationFile}') from exc
-
-    return configValue
+    """Gets the value for the section and key within config.ini (or its environment variable override)"""
+    return CONFIG.get(section, key)
+
+
+class Configuration:
+    """
+    process-wide view of config.ini
+
+    The file is parsed once and only re-read when its modification time changes, which is checked at
+    most every CONFIG_CHECK_INTERVAL seconds, so lookups are just a dictionary access. Section and key
+    names are case-insensitive. Environment variables named LMFR_<SECTION>_<KEY> override the file.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.loadedPath = None
+        self.modifiedTime = None
+        self.fileValues = {}
+        self.values = {}
+        self.nextCheck = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, section: str, key: str) -> str:
+        """function that returns a value as a string, raises a KeyError if it isn't set"""
+        if time.monotonic() >= self.nextCheck:
+            self.reload()
+        try:
+            return self.values[(section.upper(), key.upper())]
+        except KeyError as exc:
+            raise KeyError(f'Unable to find {key} in {section} within {self.loadedPath}') from exc
+
+    def getInt(self, section: str, key: str) -> int:
+        """function that returns a value as an int"""
+        return int(self.get(section, key))
+
+    def getFloat(self, section: str, key: str) -> float:
+        """function that returns a value as a float"""
+        return float(self.get(section, key))
+
+    def getBoolean(self, section: str, key: str) -> bool:
+        """function that returns a value as a bool, accepting the same words as ConfigParser (yes/no, true/false, on/off, 1/0)"""
+        value = self.get(section, key)
+        try:
+            return configparser.ConfigParser.BOOLEAN_STATES[value.lower()]
+        except KeyError as exc:
+            raise ValueError(f'{key} in {section} should be true or false, not {value}') from exc
+
+    def getPath(self, section: str, key: str) -> str:
+        """function that returns a value as a path, relative paths are taken from the folder config.ini is in"""
+        value = self.get(section, key)
+        return os.path.join(os.path.dirname(os.path.abspath(self.loadedPath)), value)
+
+    def reload(self, force: bool = False):
+        """function that re-reads config.ini if it changed, and picks up changed environment variables"""
+        with self.lock:
+            if not force and time.monotonic() < self.nextCheck:
+                return
+
+            path = self.path or findConfigFile()
+            try:
+                modifiedTime = os.stat(path).st_mtime_ns
+            except OSError:
+                modifiedTime = None
+            if force or path != self.loadedPath or modifiedTime != self.modifiedTime:
+                config = configparser.ConfigParser()
+                config.read(path)
+                self.fileValues = {(section.upper(), key.upper()): value
+                                   for section in config.sections() for key, value in config[section].items()}
+                self.loadedPath, self.modifiedTime = path, modifiedTime
+
+            # LMFR_<SECTION>_<KEY>, section names in config.ini don't contain underscores
+            environmentValues = {}
+            for name, value in os.environ.items():
+                if name.upper().startswith(CONFIG_ENVIRONMENT_PREFIX):
+                    section, _, key = name[len(CONFIG_ENVIRONMENT_PREFIX):].partition('_')
+                    environmentValues[(section.upper(), key.upper())] = value
+
+            # swap in a new dictionary so lookups in other threads never see a half built one
+            self.values = {**self.fileValues, **environmentValues}
+            self.nextCheck = time.monotonic() + CONFIG_CHECK_INTERVAL
+
+
+def findConfigFile():
+    """helper function that returns the path of config.ini, wherever the app is run from
+
+    A frozen app (see the recompile scripts) looks next to its executable first, and next to the
+    .app bundle on macOS. Otherwise the folder this file is in is used, then the current folder
+    """
+    directories = []
+    if getattr(sys, 'frozen', False):
+        executableDirectory = os.path.dirname(os.path.abspath(sys.executable))
+        directories.append(executableDirectory)
+        # gui.app/Contents/MacOS/gui
+        directories.append(os.path.abspath(os.path.join(executableDirectory, '..', '..', '..')))
+    directories.append(os.path.dirname(os.path.abspath(__file__)))
+    directories.append(os.getcwd())
+
+    for directory in directories:
+        path = os.path.join(directory, CONFIG_FILE_NAME)
+        if os.path.isfile(path):
+            return path
+    # not found anywhere, lookups will raise a KeyError naming the first place it was expected
+    return os.path.join(directories[0], CONFIG_FILE_NAME)
+
+
+# the configuration shared by the whole process
+CONFIG = Configuration()
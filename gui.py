@@ -3,6 +3,7 @@ from PyQt5 import QtCore
 import functions
 import salesforce
 import sys
+import threading
 import requests
 
 # to generate exe run: pyinstaller --onefile --windowed gui.py
@@ -50,6 +51,9 @@ class Window(QDialog):
 
         self.setLayout(mainLayout)
 
+        # parse the login WSDL in the background so it's ready by the time OK is clicked
+        threading.Thread(target=salesforce.getSoapClient, daemon=True).start()
+
     # function that creates the file picker form
     def createFilePickerForm(self):
         self.filePickerGroup = QGroupBox("File Picker")
@@ -312,18 +316,22 @@ class Window(QDialog):
             session = salesforce.loginToSalesforce(self.emailTextBox.text(
             ), self.passwordTextBox.text(), self.tokenTextBox.text())
             return True, session
-        except:
+        except salesforce.SalesforceAuthenticationError:
             self.createErrorDialogBox(
                 "Credentials invalid. Please check your credentials.")
             return False, requests.Session()
+        except Exception as err:
+            self.createErrorDialogBox(
+                "Could not log in to Salesforce.\n" + str(err))
+            return False, requests.Session()
 
     # helper function that gets the accounts and contacts dataframes from salesforce
     def getDataframes(self, session):
-        accountsDF = salesforce.getDataframeFromSalesforce(
-            'SELECT Id, Name, RecordTypeId FROM Account', session)
-        contactsDF = salesforce.getDataframeFromSalesforce(
-            'SELECT Id, Name, AccountId FROM Contact', session)
-        return accountsDF, contactsDF
+        dataframes = salesforce.getDataframesFromSalesforce({
+            'accounts': 'SELECT Id, Name, RecordTypeId FROM Account',
+            'contacts': 'SELECT Id, Name, AccountId FROM Contact'
+        }, session)
+        return dataframes['accounts'], dataframes['contacts']
 
     # the meat
     # function that does the stuff we're actually trying to do
@@ -344,10 +352,10 @@ class Window(QDialog):
                         accountsDF,
                         contactsDF,
                         session,
-                        self.donorsFileStr,
-                        self.nonprofitsFileStr,
-                        self.volunteersFileStr,
-                        self.rescuesFileStr
+                        donorFile=self.donorsFileStr,
+                        nonprofitPartner=self.nonprofitsFileStr,
+                        volunteerFile=self.volunteersFileStr,
+                        rescueFile=self.rescuesFileStr
                     )
                     # create a success dialog box if an exception is not encountered
                     self.createSuccessDialogBox("Data successfully uploaded!")
@@ -358,17 +366,19 @@ class Window(QDialog):
             if credentialsValidated:
                 try:
                     accountsDF, contactsDF = self.getDataframes(session)
-                    foodDonorsDF = functions.findDuplicateFoodDonors(accountsDF)
+                    # also catch names that are only nearly the same, e.g. "Giant Eagle #12" and "Giant Eagle  12"
+                    threshold = functions.CONFIG.getFloat('GeneralConfiguration', 'duplicateSimilarityThreshold')
+                    foodDonorsDF = functions.findDuplicateFoodDonors(accountsDF, threshold)
                     dialogBoxStr = ""
                     # does not create txt files if the dataframe is empty
                     if not self.dfIsEmpty(foodDonorsDF):
                         self.convertDFToTxt(foodDonorsDF, "duplicate_food_donors")
                         dialogBoxStr += "duplicate_food_donors.txt\n"
-                    nonprofitDF = functions.findDuplicateNonprofitPartners(accountsDF)
+                    nonprofitDF = functions.findDuplicateNonprofitPartners(accountsDF, threshold)
                     if not self.dfIsEmpty(nonprofitDF):
                         self.convertDFToTxt(nonprofitDF, "duplicate_nonprofits")
                         dialogBoxStr += "duplicate_nonprofits.txt\n"
-                    volunteersDF = functions.findDuplicateVolunteers(contactsDF)
+                    volunteersDF = functions.findDuplicateVolunteers(contactsDF, threshold)
                     if not self.dfIsEmpty(volunteersDF):
                         self.convertDFToTxt(volunteersDF, "duplicate_volunteers")
                         dialogBoxStr += "duplicate_volunteers.txt\n"
@@ -395,10 +405,7 @@ class Window(QDialog):
             if credentialsValidated:
                 try:
                     dialogBoxStr = ""
-                    choice1DF = functions.findRescueDiscrepancies(
-                        session, 1, self.rescuesFileStr)
-                    choice2DF = functions.findRescueDiscrepancies(
-                        session, 2, self.rescuesFileStr)
+                    choice1DF, choice2DF, _ = functions.findAllRescueDiscrepancies(session, self.rescuesFileStr)
                     if not self.dfIsEmpty(choice1DF):
                         self.convertDFToTxt(choice1DF, "rescue_discrepancies_not_in_admin")
                         dialogBoxStr += "rescue_discrepancies_not_in_admin.txt\n"
@@ -0,0 +1,199 @@
+import os
+import time
+import sqlite3
+import threading
+from io import StringIO
+import pandas as pd
+import functions
+import salesforce
+
+# fields kept in the mirror for each object, and the fields that get an index
+# Food_Rescue_Id__c is functions.SALESFORCE_SITE_PRIMARY_KEY, which the rescue comparison and update match on
+MIRRORED_OBJECTS = {
+    'Account': (['Id', 'Name', 'RecordTypeId'], ['Name', 'RecordTypeId']),
+    'Contact': (['Id', 'Name', 'AccountId'], ['Name', 'AccountId']),
+    'Food_Rescue__c': (['Id', 'Rescue_Id__c', 'Food_Rescue_Id__c', 'State__c', 'Day_of_Pickup__c', 'Description__c',
+                        'Food_Type__c', 'Weight__c', 'Rescue_Detail_URL__c', 'Comments__c', 'Food_Donor_Account_Name__c', 'Agency_Name__c',
+                        'Volunteer_Name__c'],
+                       ['Rescue_Id__c', 'Food_Rescue_Id__c']),
+}
+
+
+class SalesforceMirror:
+    """
+    local SQLite copy of the Account, Contact and Food_Rescue__c records this project uses
+
+    A mirror can be passed anywhere a Salesforce session is expected by the query functions in
+    salesforce.py (and the functions built on them), in which case the query is answered from
+    the local database instead of Salesforce. Call refresh() with a real session to update it.
+    """
+
+    def __init__(self, path: str = None):
+        if path is None:
+            directory = functions.CONFIG.getPath('GeneralConfiguration', 'snapshotDirectory')
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, 'mirror.sqlite')
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def refresh(self, session):
+        """function that brings every mirrored object up to date from Salesforce"""
+        for objectType, (fields, indexedFields) in MIRRORED_OBJECTS.items():
+            # only the records that changed since the last refresh are downloaded (see getSyncedDataframe)
+            df = salesforce.getSyncedDataframe(objectType, fields, session)
+            self.storeDataframe(objectType, df)
+            print('Mirrored ' + str(len(df)) + ' ' + objectType + ' records.')
+
+    def storeDataframe(self, objectType: str, df: pd.DataFrame):
+        """function that replaces the mirror's `objectType` records with the ones in `df`, and indexes them"""
+        indexedFields = MIRRORED_OBJECTS[objectType][1] if objectType in MIRRORED_OBJECTS else []
+        with self.lock, self.connection:
+            df.to_sql(objectType, self.connection, if_exists='replace', index=False)
+            if 'Id' in df.columns:
+                self.connection.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{objectType}_Id" ON "{objectType}" ("Id")')
+            for field in indexedFields:
+                if field in df.columns:
+                    self.connection.execute(f'CREATE INDEX IF NOT EXISTS "{objectType}_{field}" ON "{objectType}" ("{field}")')
+
+    def getDataframe(self, query: str, chunksize: int = None):
+        """
+        function that runs a query against the mirror and returns a Pandas Dataframe
+
+        The simple `SELECT fields FROM object [WHERE ...]` SOQL used in this project is also valid SQL.
+        If `chunksize` is given, an iterator of Dataframes is returned instead.
+        """
+        with self.lock:
+            if chunksize is None:
+                return pd.read_sql_query(query, self.connection)
+            # read everything while holding the lock, the iterator would otherwise share the connection
+            return iter(list(pd.read_sql_query(query, self.connection, chunksize=chunksize)))
+
+    def findDuplicateRecords(self, objectType: str, colName: str, filterColumn: str, filterValue: str):
+        """
+        function that returns the `objectType` records where `filterColumn` equals `filterValue`
+        and another such record has the same `colName`, using the mirror's indexes
+        """
+        query = f'''
+            SELECT * FROM "{objectType}"
+            WHERE "{filterColumn}" = ? AND "{colName}" IN (
+                SELECT "{colName}" FROM "{objectType}"
+                WHERE "{filterColumn}" = ?
+                GROUP BY "{colName}" HAVING COUNT(*) > 1
+            )
+            ORDER BY "{colName}"
+        '''
+        with self.lock:
+            return pd.read_sql_query(query, self.connection, params=(filterValue, filterValue))
+
+
+class PlanningSession(SalesforceMirror):
+    """
+    stand-in for a Salesforce session that plans uploads and updates instead of running them
+
+    Pass it anywhere a session is expected (e.g. functions.uploadDataToSalesforce). Queries are answered
+    from a copy of `source`, which is a SalesforceMirror (the default one if None) or a dict mapping
+    object names to Dataframes. Ingest jobs are not created, salesforce.executeSalesforceIngestJob
+    records their CSV payloads instead and reports every record as successful with a placeholder Id.
+    Planned inserts are added to the copy, so later steps (e.g. rescues linking to new donors) see them.
+
+    getPlan() summarizes the recorded payloads and writePlan() saves them as CSV files.
+    """
+
+    def __init__(self, source=None):
+        # an in-memory copy, so planned inserts never touch the source
+        super().__init__(':memory:')
+        if source is None:
+            source = SalesforceMirror()
+        if isinstance(source, SalesforceMirror):
+            with source.lock:
+                source.connection.backup(self.connection)
+        else:
+            for objectType, df in source.items():
+                self.storeDataframe(objectType, df)
+
+        # sources without some of the mirrored fields (e.g. a mirror refreshed before a field was added) get them blank
+        with self.lock, self.connection:
+            for objectType, (fields, _) in MIRRORED_OBJECTS.items():
+                columns = [row[1] for row in self.connection.execute(f'PRAGMA table_info("{objectType}")')]
+                if len(columns) > 0:
+                    for fieldName in fields:
+                        if fieldName not in columns:
+                            self.connection.execute(f'ALTER TABLE "{objectType}" ADD COLUMN "{fieldName}"')
+
+        self.startTime = time.perf_counter()
+        self.steps = []
+        self.placeholderCount = 0
+        self.planLock = threading.Lock()
+
+    def planIngestJob(self, operation: str, chunks: list, objectType: str, externalIdFieldName: str = None):
+        """
+        function that records the payload of an ingest job instead of running it, and returns an
+        salesforce.IngestResult as if every record succeeded
+
+        `chunks` are the CSV payloads of the jobs that would have been created
+        """
+        payloadDF = pd.concat([pd.read_csv(StringIO(chunk), dtype=str, keep_default_na=False, na_values=['']) for chunk in chunks],
+                              ignore_index=True)
+
+        with self.planLock:
+            # records that would be created get made up Ids, the others keep the Id they were sent with
+            if operation == 'insert' or 'Id' not in payloadDF.columns:
+                ids = [f'PLANNED{self.placeholderCount + i:011d}' for i in range(len(payloadDF))]
+                self.placeholderCount += len(payloadDF)
+            else:
+                ids = payloadDF['Id'].tolist()
+            step = len(self.steps) + 1
+            self.steps.append({
+                'Step': step,
+                'Operation': operation,
+                'Object': objectType,
+                'External Id': externalIdFieldName,
+                'Records': len(payloadDF),
+                'Jobs': len(chunks),
+                'Bytes': sum(len(chunk.encode('utf-8')) for chunk in chunks),
+                'Seconds': time.perf_counter() - self.startTime,
+                'Payloads': chunks
+            })
+
+        if operation == 'insert' and objectType in MIRRORED_OBJECTS:
+            self.addPlannedRecords(objectType, payloadDF.assign(Id=ids))
+
+        print('Planned ' + operation + ' of ' + str(len(payloadDF)) + ' ' + objectType + ' records in ' + str(len(chunks))
+              + ' job(s), nothing was sent to Salesforce.\n')
+
+        successfulResults = payloadDF.copy()
+        successfulResults.insert(0, 'sf__Created', 'true' if operation in ('insert', 'upsert') else 'false')
+        successfulResults.insert(0, 'sf__Id', ids)
+        failedResults = pd.DataFrame(columns=['sf__Id', 'sf__Error'] + list(payloadDF.columns))
+        jobIds = [f'PLANNED{step}-{job}' for job in range(1, len(chunks) + 1)]
+        return salesforce.IngestResult(operation, objectType, jobIds, len(payloadDF), 0, successfulResults, failedResults)
+
+    def addPlannedRecords(self, objectType: str, recordsDF: pd.DataFrame):
+        """helper function that adds planned inserts to the copy, keeping only the mirrored fields"""
+        if objectType == 'Contact' and 'Name' not in recordsDF.columns:
+            recordsDF = recordsDF.assign(Name=(recordsDF['FirstName'].fillna('') + ' ' + recordsDF['LastName'].fillna('')).str.strip())
+        recordsDF = recordsDF.reindex(columns=MIRRORED_OBJECTS[objectType][0])
+        with self.lock, self.connection:
+            recordsDF.to_sql(objectType, self.connection, if_exists='append', index=False)
+
+    def getPlan(self):
+        """function that returns a Dataframe with one row per planned job payload: what it does, how big it is and when it was planned"""
+        with self.planLock:
+            return pd.DataFrame(self.steps, columns=['Step', 'Operation', 'Object', 'External Id', 'Records', 'Jobs', 'Bytes', 'Seconds'])
+
+    def writePlan(self, directory: str):
+        """
+        function that writes the summary as plan.csv and every planned payload to `directory`, exactly as it
+        would have been uploaded, named <step>_<operation>_<object>.csv (with _<job> added if it was split)
+        """
+        os.makedirs(directory, exist_ok=True)
+        with self.planLock:
+            steps = list(self.steps)
+        for step in steps:
+            name = f'{step["Step"]:02d}_{step["Operation"]}_{step["Object"]}'
+            for job, payload in enumerate(step['Payloads'], start=1):
+                fileName = name + ('.csv' if len(step['Payloads']) == 1 else f'_{job}.csv')
+                with open(os.path.join(directory, fileName), 'w', encoding='utf-8', newline='') as file:
+                    file.write(payload)
+        self.getPlan().to_csv(os.path.join(directory, 'plan.csv'), index=False)
@@ -1,29 +1,395 @@
+import os
 import time
 import json
-import sys
-from io import StringIO
+import re
+import heapq
+import random
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 import requests
 import pandas as pd
 from zeep import Client
+from zeep.exceptions import Fault
 import functions
+import mirror
 
+# number of records requested per page of query results
+QUERY_PAGE_SIZE = 50000
+
+# Bulk 2.0 rejects uploads over 150 MB per job, leave headroom for the base64 encoding Salesforce applies
+MAX_INGEST_BYTES = 100 * 1024 * 1024
+
+# number of ingest jobs submitted to Salesforce at the same time
+MAX_CONCURRENT_JOBS = 4
+
+# job status polling starts quickly and backs off to POLL_MAX_DELAY seconds between checks
+POLL_INITIAL_DELAY = 0.25
+POLL_MAX_DELAY = 15
+
+# seconds to wait for a single job before giving up
+JOB_TIMEOUT = 60 * 60
+
+# ingest errors that usually go away when the record is sent again (e.g. another job held a lock on its parent)
+RETRYABLE_INGEST_ERRORS = ('UNABLE_TO_LOCK_ROW', 'REQUEST_RUNNING_TOO_LONG', 'SERVER_UNAVAILABLE')
+
+# field holding each object's parent record, retried records are sorted on it so records sharing a parent go in the same job
+INGEST_PARENT_FIELDS = {'Account': 'ParentId', 'Contact': 'AccountId', 'Food_Rescue__c': 'Food_Donor_Account_Name__c'}
+
+# retried records are sent in jobs of at most INGEST_RETRY_BATCH_SIZE records, one job at a time, INGEST_RETRY_DELAY seconds apart
+INGEST_RETRY_BATCH_SIZE = 1000
+INGEST_RETRY_DELAY = 2
+
+# columns Salesforce (and _parseIngestErrors) add to the uploaded columns in an ingest job's results
+INGEST_RESULT_COLUMNS = ('sf__Id', 'sf__Created', 'sf__Error', 'Error Code', 'Error Message')
+
+# states after which Salesforce will not change a job any further
+TERMINAL_JOB_STATES = ('JobComplete', 'Failed', 'Aborted')
+
+# query results are reused for QUERY_CACHE_TTL seconds, keeping at most QUERY_CACHE_SIZE results
+QUERY_CACHE_TTL = 15 * 60
+QUERY_CACHE_SIZE = 32
+
+# seconds before a session's expiry at which it is renewed
+SESSION_EXPIRY_MARGIN = 5 * 60
+
+# HTTP statuses Salesforce answers with when it is throttling or briefly unavailable, requests are retried on them
+RETRYABLE_STATUS_CODES = (429, 502, 503, 504)
+# of those, the statuses that mean the request was turned away without being acted on, so even a POST can be sent again
+REJECTED_STATUS_CODES = (429, 503)
+# methods that can be sent again without changing the outcome
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'PATCH', 'DELETE')
+
+# retries start about RETRY_INITIAL_DELAY seconds apart and back off to RETRY_MAX_DELAY, giving up after MAX_RETRIES
+MAX_RETRIES = 6
+RETRY_INITIAL_DELAY = 1
+RETRY_MAX_DELAY = 60
+
+# deleted records are dropped from local snapshots once every SNAPSHOT_RECONCILE_INTERVAL seconds
+SNAPSHOT_RECONCILE_INTERVAL = 24 * 60 * 60
+
+# seconds of overlap when querying changes since a snapshot's watermark
+SNAPSHOT_WATERMARK_OVERLAP = 5 * 60
+
+# field types are looked up again after DESCRIBE_CACHE_TTL seconds
+DESCRIBE_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Pandas dtypes used for each Salesforce field type when reading query results
+# Ids of related records and picklist values repeat a lot, so they're stored as categories
+FIELD_DTYPES = {
+    'reference': 'category',
+    'picklist': 'category',
+    'double': 'Float64',
+    'currency': 'Float64',
+    'percent': 'Float64',
+    'int': 'Int64',
+    'boolean': 'boolean',
+}
+DATE_FIELD_TYPES = ('date', 'datetime')
+# number field types that can have decimal places, those defined without any (scale 0, e.g. Rescue_Id__c) are read as 'int'
+DECIMAL_FIELD_TYPES = ('double', 'currency', 'percent')
+
+JSON_HEADERS = {'Content-Type': 'application/json;charset=utf-8'}
+CSV_HEADERS = {'Content-Type': 'text/csv;charset=UTF-8'}
+
+# (org, normalised SOQL) -> (time stored, objects queried, Dataframe), least recently used first
+_queryCache = OrderedDict()
+_queryCacheLock = threading.Lock()
+
+# only one thread reads or writes the snapshot files at a time
+_snapshotLock = threading.Lock()
+
+# (org, object) -> {field name: Salesforce type}
+_describeCache = {}
+_describeLock = threading.Lock()
+
+# SOAP client built from the WSDL, shared by every login
+_soapClient = None
+_soapClientLock = threading.Lock()
+
+# hash of the credentials -> SalesforceSession
+_sessionCache = {}
+_loginLock = threading.Lock()
+
+# journal of the checkpointed run in progress, if any (see checkpointedRun)
+_checkpointJournal = None
+
+
+@dataclass
+class IngestResult:
+    """combined results of the ingest jobs created for one executeSalesforceIngestJob call"""
+    operation: str
+    objectType: str
+    jobIds: list = field(default_factory=list)
+    numberRecordsProcessed: int = 0
+    numberRecordsFailed: int = 0
+    successfulResults: pd.DataFrame = field(default_factory=pd.DataFrame)
+    failedResults: pd.DataFrame = field(default_factory=pd.DataFrame)
+
+    def getFailureReport(self):
+        """function that returns the failed records grouped by error code, most common first, with an example message for each"""
+        if len(self.failedResults) == 0 or 'Error Code' not in self.failedResults.columns:
+            return pd.DataFrame(columns=['Error Code', 'Records', 'Example Message'])
+        reportDF = self.failedResults.groupby('Error Code', sort=False).agg(
+            Records=('Error Code', 'size'), ExampleMessage=('Error Message', 'first'))
+        reportDF = reportDF.sort_values('Records', ascending=False, kind='stable').reset_index()
+        return reportDF.rename(columns={'ExampleMessage': 'Example Message'})
+
+class SalesforceError(Exception):
+    """base class of the errors raised when Salesforce can't do what was asked"""
+
+class SalesforceRequestError(SalesforceError):
+    """a request Salesforce answered with an error (after any retries), `response` is its requests.Response"""
+
+    def __init__(self, message: str, response: requests.Response = None):
+        self.response = response
+        self.statusCode = None if response is None else response.status_code
+        self.errors = _getResponseErrors(response)
+        if response is not None:
+            message += ' (HTTP ' + str(response.status_code) + ')'
+        if self.errors:
+            message += ': ' + '; '.join(self.errors)
+        super().__init__(message)
+
+class SalesforceAuthenticationError(SalesforceRequestError):
+    """the credentials were rejected, or the session was rejected even after logging in again"""
+
+class SalesforceUnavailableError(SalesforceRequestError):
+    """Salesforce kept throttling the request, was unavailable or couldn't be reached, even after MAX_RETRIES retries"""
+
+class SalesforceJobError(SalesforceError):
+    """a query or ingest job ended in the Failed or Aborted state"""
+
+    def __init__(self, jobType: str, jobId: str, state: str, errorMessage: str = None):
+        self.jobId = jobId
+        self.state = state
+        self.errorMessage = errorMessage
+        message = jobType.capitalize() + ' job ' + jobId + ' ' + state + '. Please check Bulk Data Load Jobs in Salesforce Setup'
+        if errorMessage:
+            message += ': ' + errorMessage
+        super().__init__(message)
+
+def _getResponseErrors(response: requests.Response):
+    """helper function that returns the error messages in a Salesforce error response as strings"""
+    if response is None:
+        return []
+    try:
+        body = response.json()
+    except ValueError:
+        return [response.text[:1000]] if response.text else []
+    # REST errors are a list of {'errorCode': ..., 'message': ...}
+    if isinstance(body, dict):
+        body = [body]
+    if isinstance(body, list):
+        return [str(error.get('errorCode', '')) + ': ' + str(error.get('message', '')) if isinstance(error, dict) else str(error)
+                for error in body]
+    return [str(body)]
+
+def _checkResponse(response: requests.Response, expectedStatusCodes: tuple, action: str):
+    """helper function that raises the matching SalesforceRequestError unless `response` has one of `expectedStatusCodes`"""
+    if response.status_code in expectedStatusCodes:
+        return response
+    if response.status_code == 401:
+        raise SalesforceAuthenticationError(action + ' failed, the Salesforce session was rejected', response)
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        raise SalesforceUnavailableError(action + ' failed, Salesforce is busy or unavailable', response)
+    raise SalesforceRequestError(action + ' failed', response)
+
+def _getRetryAfter(response: requests.Response):
+    """helper function that returns how many seconds a response's Retry-After header asks to wait, or 0"""
+    retryAfter = response.headers.get('Retry-After')
+    if not retryAfter:
+        return 0
+    try:
+        return max(0, float(retryAfter))
+    except ValueError:
+        pass
+    # it can also be an HTTP date
+    try:
+        return max(0, parsedate_to_datetime(retryAfter).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+class SalesforceSession(requests.Session):
+    """
+    requests.Session for the Salesforce APIs that rides out throttling, outages and expired sessions
+
+    Requests answered with one of RETRYABLE_STATUS_CODES, or that fail to connect, are retried up to
+    MAX_RETRIES times with exponential backoff and jitter, waiting at least as long as Retry-After asks.
+    Requests Salesforce may already have acted on are only retried for IDEMPOTENT_METHODS, so a POST
+    is retried only when it was turned away (REJECTED_STATUS_CODES) or never connected. Whatever
+    response comes last is returned, callers check its status as with requests.Session.
+
+    `login` is called to start the session, and again when it is about to expire or Salesforce answers
+    401. It returns the session ID and the number of seconds it is valid for (or None if unknown).
+    """
+
+    def __init__(self, login=None):
+        super().__init__()
+        self.login = login
+        self.expiresAt = None
+        self.loginLock = threading.Lock()
+        if login is not None:
+            self.refresh()
+
+    def refresh(self, staleAuthorization: str = None):
+        """function that logs in again, unless another thread already did since `staleAuthorization` was sent"""
+        with self.loginLock:
+            if staleAuthorization is not None and self.headers.get('Authorization') != staleAuthorization:
+                return
+            sessionId, secondsValid = self.login()
+            self.headers['Authorization'] = 'Bearer ' + sessionId
+            self.expiresAt = None if secondsValid is None else time.monotonic() + secondsValid - SESSION_EXPIRY_MARGIN
+
+    def request(self, method, url, *args, **kwargs):
+        if self.login is not None and self.expiresAt is not None and time.monotonic() >= self.expiresAt:
+            print('The Salesforce session is about to expire, logging in again.')
+            self.refresh(self.headers.get('Authorization'))
+
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        loggedInAgain = False
+        delay = RETRY_INITIAL_DELAY
+        # retries so far, logging in again doesn't count as one
+        attempt = 0
+        while True:
+            authorization = self.headers.get('Authorization')
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                # a request that never connected can't have been acted on
+                if not (idempotent or isinstance(err, requests.ConnectTimeout)) or attempt == MAX_RETRIES:
+                    raise SalesforceUnavailableError(method.upper() + ' ' + url + ' failed, Salesforce could not be reached: ' + str(err)) from err
+                reason = 'could not be reached'
+                retryAfter = 0
+            else:
+                if response.status_code == 401 and self.login is not None and not loggedInAgain:
+                    print('The Salesforce session expired, logging in again.')
+                    self.refresh(authorization)
+                    loggedInAgain = True
+                    continue
+                if (response.status_code not in RETRYABLE_STATUS_CODES or attempt == MAX_RETRIES
+                        or not (idempotent or response.status_code in REJECTED_STATUS_CODES)):
+                    return response
+                reason = 'answered HTTP ' + str(response.status_code)
+                retryAfter = _getRetryAfter(response)
+                response.close()
+
+            seconds = max(random.uniform(delay / 2, delay), retryAfter)
+            attempt += 1
+            print(f'Salesforce {reason}, retrying in {seconds:.0f} seconds ({attempt}/{MAX_RETRIES})...')
+            time.sleep(seconds)
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+
+class CheckpointJournal:
+    """
+    record of a run's finished stages and ingest jobs, appended to a JSON lines file as the run goes
+    so that a run that stopped part way can be continued (see checkpointedRun)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stages = set()
+        # payload hash -> latest entry for the job that uploaded it
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        self._apply(json.loads(line))
+                    except json.JSONDecodeError:
+                        # the last line of a run that was killed while writing it
+                        continue
+        # whether an earlier attempt of the run left anything behind
+        self.resumed = not self.isEmpty()
+
+    def _apply(self, entry: dict):
+        if entry['event'] == 'stage':
+            self.stages.add(entry['stage'])
+        elif entry['event'] == 'job':
+            self.jobs[entry['payloadHash']] = entry
+
+    def record(self, **entry):
+        """function that appends an entry to the journal and makes sure it is on disk before returning"""
+        entry['time'] = time.time()
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(entry) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self._apply(entry)
+
+    def isEmpty(self):
+        """function that returns whether nothing has been recorded yet"""
+        with self.lock:
+            return not self.stages and not self.jobs
+
+    def isStageDone(self, stage: str):
+        """function that returns whether `stage` finished in this or an earlier attempt of the run"""
+        with self.lock:
+            return stage in self.stages
+
+    def getCompletedJobId(self, payloadHash: str):
+        """function that returns the ID of the completed job that already uploaded this payload, or None"""
+        with self.lock:
+            entry = self.jobs.get(payloadHash)
+        if entry is not None and entry['state'] == 'JobComplete':
+            return entry['jobId']
+        return None
+
+    def getUnfinishedJobs(self):
+        """function that returns the entries of the jobs that hadn't finished when the last attempt stopped"""
+        with self.lock:
+            return [entry for entry in self.jobs.values() if entry['state'] not in TERMINAL_JOB_STATES]
 
 def loginToSalesforce(username: str, password: str, securityToken: str):
-    """login function that returns a Salesforce API session"""
-    wsdl = './basic_wsdl.xml'
+    """
+    login function that returns a Salesforce API session (a SalesforceSession)
 
-    # Creates the session in order to be able to pull out the Session ID
-    SOAPclient = Client(wsdl)
-    data = {'username': username, 'password': password+securityToken}
-    response = SOAPclient.service.login(**data)
-    sessionId = response.sessionId
+    The session logs in again by itself when it expires, so logging in again with the same
+    credentials reuses it instead of making another SOAP call.
+    Raises SalesforceAuthenticationError if the credentials are rejected.
+    """
+    credentialsKey = hashlib.sha256('\0'.join([username, password, securityToken]).encode('utf-8')).hexdigest()
+    with _loginLock:
+        if credentialsKey in _sessionCache:
+            return _sessionCache[credentialsKey]
 
     # create session for Bulk 2.0 API calls
-    session = requests.Session()
-    session.headers.update({'Authorization': 'Bearer ' + sessionId})
+    session = SalesforceSession(lambda: _loginWithSoap(username, password, securityToken))
+    with _loginLock:
+        _sessionCache[credentialsKey] = session
 
     return session
 
+def _loginWithSoap(username: str, password: str, securityToken: str):
+    """helper function that logs in through the SOAP API and returns the session ID and how many seconds it is valid for"""
+    SOAPclient = getSoapClient()
+    data = {'username': username, 'password': password+securityToken}
+    try:
+        response = SOAPclient.service.login(**data)
+    except Fault as err:
+        raise SalesforceAuthenticationError('Salesforce login failed: ' + str(err.message)) from err
+    return response.sessionId, int(response.userInfo.sessionSecondsValid)
+
+def getSoapClient():
+    """
+    function that returns the SOAP client used to log in
+
+    Parsing the WSDL takes a few seconds, so the client is built once per process.
+    Call this early (e.g. from a background thread) to have it ready before the first login.
+    """
+    global _soapClient
+    with _soapClientLock:
+        if _soapClient is None:
+            _soapClient = Client('./basic_wsdl.xml')
+        return _soapClient
+
 def loginToSalesforceSANDBOX(username: str, password: str, securityToken: str, clientId: str, clientSecret: str):
     """
     DEVELOPMENT MODE -- FOR TESTING ONLY
@@ -34,145 +400,771 @@ def loginToSalesforceSANDBOX(username: str, password: str, securityToken: str, c
     """
     data = {'grant_type': 'password', 'client_id': clientId, 'client_secret': clientSecret,
             'username': username, 'password': password+securityToken}
-    response = requests.post('https://test.salesforce.com/services/oauth2/token', data=data)
-    sessionId = response.json()['access_token']
 
-    # create session for Bulk 2.0 API calls
-    session = requests.Session()
-    session.headers.update({'Authorization': 'Bearer ' + sessionId})
+    def login():
+        response = requests.post('https://test.salesforce.com/services/oauth2/token', data=data)
+        if response.status_code != 200:
+            raise SalesforceAuthenticationError('Salesforce sandbox login failed', response)
+        # the token's lifetime isn't returned, it is renewed when Salesforce rejects it
+        return response.json()['access_token'], None
 
-    return session
+    # create session for Bulk 2.0 API calls
+    return SalesforceSession(login)
 
-def getDataframeFromSalesforce(query: str, session: requests.Session):
+def getDataframeFromSalesforce(query: str, session: requests.Session, useCache: bool = True):
     """
     SALESFORCE BULK 2.0 API FUNCTIONS: QUERY AND INGEST
     function to query Salesforce and return a Pandas Dataframe
+
+    Results are kept in the query cache (see clearQueryCache) unless `useCache` is False.
+    `session` can also be a mirror.SalesforceMirror to read from the local mirror instead.
+    Raises SalesforceJobError if the query job fails and SalesforceRequestError if a request is refused.
+    """
+    if isinstance(session, mirror.SalesforceMirror):
+        return session.getDataframe(query)
+
+    uri = functions.getConfigValue('GeneralConfiguration', 'uri')
+    if useCache:
+        df = _getCachedQuery(query, uri)
+        if df is not None:
+            return df
+
+    df = _concatDataframes(iterDataframesFromSalesforce(query, session))
+    if useCache:
+        _putCachedQuery(query, uri, df)
+        df = df.copy()
+    return df
+
+def getDataframesFromSalesforce(queries: dict, session: requests.Session, useCache: bool = True):
+    """
+    function to run several queries at the same time
+
+    `queries` maps a name to a SOQL statement. Every query job is created up front and the jobs
+    are waited on together, so this takes about as long as the slowest query.
+    Returns a dict mapping each name to its Pandas Dataframe. Cached results are reused as in
+    getDataframeFromSalesforce.
+    """
+    if isinstance(session, mirror.SalesforceMirror):
+        return {name: session.getDataframe(query) for name, query in queries.items()}
+
+    uri = functions.getConfigValue('GeneralConfiguration', 'uri')
+
+    # only create jobs for the queries that aren't already cached
+    dataframes = {}
+    if useCache:
+        for name, query in queries.items():
+            df = _getCachedQuery(query, uri)
+            if df is not None:
+                dataframes[name] = df
+
+    # create all of the query jobs before waiting on any of them
+    namesByJobId = {_createQueryJob(query, session, uri): name for name, query in queries.items() if name not in dataframes}
+    readArguments = {name: _getReadArguments(queries[name], session) for name in namesByJobId.values()}
+
+    # download each job's results in the background as soon as the job completes
+    if namesByJobId:
+        print('Waiting for query jobs to complete...')
+    downloads = {}
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS) as executor:
+        for jobId, jsonRes in waitForJobs('query', list(namesByJobId), session):
+            _checkQueryJob(jsonRes)
+            name = namesByJobId[jobId]
+            downloads[name] = executor.submit(_getQueryResults, uri, jobId, readArguments[name], session)
+
+        for name, download in downloads.items():
+            dataframes[name] = download.result()
+            if useCache:
+                _putCachedQuery(queries[name], uri, dataframes[name])
+                dataframes[name] = dataframes[name].copy()
+
+    return {name: dataframes[name] for name in queries}
+
+def getSyncedDataframe(objectType: str, fields: list, session: requests.Session):
     """
+    function that returns the current `fields` of every `objectType` record, downloading only what changed
+
+    A snapshot of the records is kept in the snapshot directory (see config.ini) together with the
+    latest SystemModstamp seen. Each call queries only the records modified since then and merges
+    them into the snapshot, so the cost grows with the number of changes rather than the size of the
+    object. Records deleted in Salesforce are dropped from the snapshot by comparing against the full
+    list of Ids once every SNAPSHOT_RECONCILE_INTERVAL seconds.
+
+    There is one snapshot per org and object, holding every field any caller has asked for. Asking
+    for a field it doesn't have yet downloads the object again once with the field added.
+    """
+    if isinstance(session, mirror.SalesforceMirror):
+        return session.getDataframe('SELECT ' + ', '.join(fields) + ' FROM ' + objectType)
+
     uri = functions.getConfigValue('GeneralConfiguration', 'uri')
-    session.headers.update({'Content-Type': 'application/json;charset=utf-8'})
+    directory = functions.CONFIG.getPath('GeneralConfiguration', 'snapshotDirectory')
+
+    # one snapshot per org and object
+    snapshotName = objectType + '_' + hashlib.sha1(urlsplit(uri).netloc.encode('utf-8')).hexdigest()[:12]
+    dataPath = os.path.join(directory, snapshotName + '.pkl')
+    metadataPath = os.path.join(directory, snapshotName + '.json')
+
+    with _snapshotLock:
+        if os.path.exists(dataPath) and os.path.exists(metadataPath):
+            snapshotDF = pd.read_pickle(dataPath)
+            with open(metadataPath) as metadataFile:
+                metadata = json.load(metadataFile)
+        else:
+            snapshotDF = None
+            metadata = {}
+
+        # the snapshot keeps the fields it already has and gains the ones asked for now
+        snapshotFields = metadata.get('fields', [])
+        newFields = [f for f in fields if f not in snapshotFields and f not in ('Id', 'SystemModstamp')]
+        queryFields = ['Id'] + [f for f in snapshotFields + newFields if f not in ('Id', 'SystemModstamp')] + ['SystemModstamp']
+        query = 'SELECT ' + ', '.join(queryFields) + ' FROM ' + objectType
+
+        if snapshotDF is None or metadata.get('watermark') is None or newFields:
+            if snapshotDF is None:
+                print('Downloading all ' + objectType + ' records to start a local snapshot...')
+            else:
+                print('Downloading all ' + objectType + ' records again to add ' + ', '.join(newFields) + ' to the local snapshot...')
+            snapshotDF = getDataframeFromSalesforce(query, session, useCache=False)
+            metadata['fields'] = queryFields
+            metadata['lastReconcile'] = time.time()
+        else:
+            print('Downloading ' + objectType + ' records changed since ' + metadata['watermark'] + '...')
+            changesDF = getDataframeFromSalesforce(query + ' WHERE SystemModstamp >= ' + metadata['watermark'], session, useCache=False)
+            if len(changesDF) > 0:
+                snapshotDF = _concatDataframes([snapshotDF[~snapshotDF['Id'].isin(changesDF['Id'])], changesDF])
 
-    # create a job to query all Account records
+            # deleted records never show up as changes, so periodically check which Ids still exist
+            if time.time() - metadata['lastReconcile'] > SNAPSHOT_RECONCILE_INTERVAL:
+                print('Checking for deleted ' + objectType + ' records...')
+                idsDF = getDataframeFromSalesforce('SELECT Id FROM ' + objectType, session, useCache=False)
+                snapshotDF = snapshotDF[snapshotDF['Id'].isin(idsDF['Id'])].reset_index(drop=True)
+                metadata['lastReconcile'] = time.time()
+
+        # back the watermark off a little so records committed slightly out of order aren't missed
+        if len(snapshotDF) > 0:
+            watermark = pd.to_datetime(snapshotDF['SystemModstamp'], utc=True).max() - pd.Timedelta(seconds=SNAPSHOT_WATERMARK_OVERLAP)
+            metadata['watermark'] = watermark.strftime('%Y-%m-%dT%H:%M:%SZ')
+        else:
+            metadata['watermark'] = None
+
+        # write to temporary files first so an interrupted run can't leave a half written snapshot
+        os.makedirs(directory, exist_ok=True)
+        snapshotDF.to_pickle(dataPath + '.tmp')
+        with open(metadataPath + '.tmp', 'w') as metadataFile:
+            json.dump(metadata, metadataFile)
+        os.replace(dataPath + '.tmp', dataPath)
+        os.replace(metadataPath + '.tmp', metadataPath)
+
+    return snapshotDF[list(fields)].copy()
+
+def iterDataframesFromSalesforce(query: str, session: requests.Session, maxRecords: int = QUERY_PAGE_SIZE):
+    """
+    function to query Salesforce and yield the results one page at a time
+
+    Pages are walked with the Sforce-Locator header, at most `maxRecords` rows each.
+    The next page is downloaded in the background while the current one is being used,
+    so no more than two pages are held in memory at once.
+    """
+    if isinstance(session, mirror.SalesforceMirror):
+        yield from session.getDataframe(query, chunksize=maxRecords)
+        return
+
+    uri = functions.getConfigValue('GeneralConfiguration', 'uri')
+    jobId = _createQueryJob(query, session, uri)
+    readArguments = _getReadArguments(query, session)
+
+    # wait for job to complete before getting results
+    print('Waiting for query job to complete...')
+    _checkQueryJob(waitForJob('query', jobId, session))
+
+    yield from _iterQueryResults(uri, jobId, maxRecords, readArguments, session)
+
+def _createQueryJob(query: str, session: requests.Session, uri: str):
+    """helper function that creates a query job and returns its ID"""
     data = json.dumps({
         "operation": "query",
         "query": query,
     })
-    response = session.post(uri + 'query', data=data)
+    response = session.post(uri + 'query', data=data, headers=JSON_HEADERS)
 
     # Makes sure that the query job was created successfully
-    if response.status_code == 200:
-        print('Query job created.')
-    else:
-        print('Query job creation failed:\n' + str(response.json()))
-        sys.exit()
+    _checkResponse(response, (200,), 'Query job creation')
+    print('Query job created.')
 
     # pull out job ID to use for future requests
-    jobId = response.json().get('id')
+    return response.json().get('id')
 
-    # wait for job to complete before getting results
-    print('Waiting for query job to complete...')
-    jobComplete = False
+def _checkQueryJob(jsonRes: dict):
+    """helper function that raises SalesforceJobError if a finished query job did not complete successfully"""
+    if jsonRes['state'] != 'JobComplete':
+        raise SalesforceJobError('query', str(jsonRes.get('id')), str(jsonRes['state']), jsonRes.get('errorMessage'))
 
-    # Checks to see if the query job has been completed
-    while not jobComplete:
-        response = session.get(uri+'query/'+jobId)
-        jsonRes = response.json()
-        if str(jsonRes['state']) == 'JobComplete':
-            jobComplete = True
-        time.sleep(0.5)
+def _getQueryResults(uri: str, jobId: str, readArguments: dict, session: requests.Session):
+    """helper function that downloads all of a completed query job's results into one Dataframe"""
+    return _concatDataframes(_iterQueryResults(uri, jobId, QUERY_PAGE_SIZE, readArguments, session))
+
+def _iterQueryResults(uri: str, jobId: str, maxRecords: int, readArguments: dict, session: requests.Session):
+    """helper function that yields a completed query job's results page by page, prefetching the next page"""
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        nextPage = executor.submit(_getQueryResultsPage, uri, jobId, None, maxRecords, readArguments, session)
+        while nextPage is not None:
+            df, locator = nextPage.result()
+            if locator is not None:
+                nextPage = executor.submit(_getQueryResultsPage, uri, jobId, locator, maxRecords, readArguments, session)
+            else:
+                nextPage = None
+            yield df
 
-    # get job results
-    response = session.get(uri+'query/'+jobId+'/results')
-    s = str(response.content, 'utf-8')
-    data = StringIO(s)
+def _getQueryResultsPage(uri: str, jobId: str, locator, maxRecords: int, readArguments: dict, session: requests.Session):
+    """helper function that downloads one page of query results and returns it with the locator of the next page"""
+    params = {'maxRecords': maxRecords}
+    if locator is not None:
+        params['locator'] = locator
+    response = session.get(uri+'query/'+jobId+'/results', params=params, stream=True)
+    _checkResponse(response, (200,), 'Downloading the results of query job ' + jobId)
 
-    df = pd.read_csv(data)
+    # parse the CSV straight off the socket instead of buffering the whole body first
+    response.raw.decode_content = True
+    df = pd.read_csv(response.raw, **readArguments)
+
+    # Salesforce sends the string 'null' once the last page has been reached
+    locator = response.headers.get('Sforce-Locator')
+    if locator in (None, '', 'null'):
+        locator = None
+    return df, locator
+
+def getFieldTypes(objectType: str, session: requests.Session):
+    """
+    function that returns a dict mapping each field of `objectType` to its Salesforce type
+
+    The types come from the object's describe call and are cached in memory and in the
+    snapshot directory for DESCRIBE_CACHE_TTL seconds. Number fields without decimal places
+    (see DECIMAL_FIELD_TYPES) are given the type 'int', so their values are read as whole numbers.
+    Returns an empty dict if the describe call fails.
+    """
+    uri = functions.getConfigValue('GeneralConfiguration', 'uri')
+    host = urlsplit(uri).netloc
+    with _describeLock:
+        if (host, objectType) in _describeCache:
+            return _describeCache[(host, objectType)]
+
+        directory = functions.CONFIG.getPath('GeneralConfiguration', 'snapshotDirectory')
+        describePath = os.path.join(directory, 'fieldtypes_' + objectType + '_' + hashlib.sha1(host.encode('utf-8')).hexdigest()[:12] + '.json')
+        if os.path.exists(describePath) and time.time() - os.path.getmtime(describePath) < DESCRIBE_CACHE_TTL:
+            with open(describePath) as describeFile:
+                fieldTypes = json.load(describeFile)
+        else:
+            # the Bulk 2.0 jobs uri sits next to the sObject describe endpoints
+            response = session.get(uri.split('jobs/')[0] + 'sobjects/' + objectType + '/describe', headers=JSON_HEADERS)
+            if response.status_code != 200:
+                return {}
+            fieldTypes = {}
+            for fieldDescription in response.json()['fields']:
+                fieldType = fieldDescription['type']
+                if fieldType in DECIMAL_FIELD_TYPES and fieldDescription.get('scale') == 0:
+                    fieldType = 'int'
+                fieldTypes[fieldDescription['name']] = fieldType
+            os.makedirs(directory, exist_ok=True)
+            with open(describePath, 'w') as describeFile:
+                json.dump(fieldTypes, describeFile)
+
+        _describeCache[(host, objectType)] = fieldTypes
+        return fieldTypes
+
+def _getReadArguments(query: str, session: requests.Session):
+    """helper function that builds the pd.read_csv dtype and date arguments for a query's results from its object's field types"""
+    match = re.match(r'\s*select\s+(.+?)\s+from\s+(\w+)', query, re.IGNORECASE | re.DOTALL)
+    if match is None:
+        return {}
+    fieldTypes = {name.lower(): fieldType for name, fieldType in getFieldTypes(match.group(2), session).items()}
+
+    dtypes = {}
+    dateColumns = []
+    for fieldName in match.group(1).split(','):
+        fieldName = fieldName.strip()
+        fieldType = fieldTypes.get(fieldName.lower())
+        if fieldType in FIELD_DTYPES:
+            dtypes[fieldName] = FIELD_DTYPES[fieldType]
+        elif fieldType in DATE_FIELD_TYPES:
+            dateColumns.append(fieldName)
+    return {'dtype': dtypes, 'parse_dates': dateColumns}
+
+def _concatDataframes(dfs):
+    """helper function that concatenates Dataframes, keeping columns that were categorical as categories"""
+    dfs = list(dfs)
+    df = pd.concat(dfs, ignore_index=True)
+
+    # pages with different category values concatenate to plain objects, so convert those back
+    for column in df.columns:
+        if df[column].dtype != 'category' and any(column in part and part[column].dtype == 'category' for part in dfs):
+            df[column] = df[column].astype('category')
     return df
 
-def executeSalesforceIngestJob(operation: str, importData: pd.DataFrame, objectType: str, session: requests.Session):
+def executeSalesforceIngestJob(operation: str, importData: str, objectType: str, session: requests.Session, externalIdFieldName: str = None,
+                               fetchSuccessfulResults: bool = False, maxBytes: int = MAX_INGEST_BYTES):
     """
-    function to create and execute a Salesforce bulk upload or delete job
+    function to create and execute a Salesforce bulk upload, upsert, update or delete job
+
+    Upserts match existing records on `externalIdFieldName`, which is required for them.
+
+    `importData` is CSV text. Payloads larger than `maxBytes` are split on row boundaries
+    (each piece keeps the header) and submitted as several jobs running at the same time.
+    Returns an IngestResult with the combined counts and failed rows of every job. The failed rows
+    (and the successful rows, if `fetchSuccessfulResults` is True) are Dataframes of the uploaded
+    columns plus Salesforce's sf__Id and sf__Error or sf__Created columns. The failed rows also get
+    the sf__Error split into 'Error Code' and 'Error Message' columns.
+    Rows that failed with one of RETRYABLE_INGEST_ERRORS are sent again (see _retryFailedRows), so the
+    failed rows and numberRecordsFailed are the failures that are left afterwards.
+    `session` can also be a mirror.PlanningSession, which records the payloads without creating jobs.
+    Raises SalesforceJobError if a job fails and SalesforceRequestError if a request is refused (SalesforceSession
+    retries throttled requests first).
     """
     uri = functions.getConfigValue('GeneralConfiguration', 'uri')
 
+    chunks = list(_splitCsvPayload(importData, maxBytes))
+    if len(chunks) > 1:
+        print('Splitting data into ' + str(len(chunks)) + ' jobs.')
+
+    # plan mode: record what would be sent instead of creating any jobs
+    if isinstance(session, mirror.PlanningSession):
+        return session.planIngestJob(operation, chunks, objectType, externalIdFieldName)
+
+    result = _runIngestJobs(operation, chunks, objectType, externalIdFieldName, session, uri, fetchSuccessfulResults)
+    if result.numberRecordsFailed > 0:
+        result.failedResults = _parseIngestErrors(result.failedResults)
+        _retryFailedRows(result, externalIdFieldName, session, uri, fetchSuccessfulResults)
+
+    if operation == 'insert':
+        print('Upload complete!\n')
+    elif operation == 'upsert':
+        print('Upsert complete!\n')
+    if operation == 'update':
+        print('Update complete!\n')
+    elif operation == 'delete':
+        print('Deletion complete.\n')
+
+    # display job results to user
+    print('Job results:')
+    print('Records processed: ' + str(result.numberRecordsProcessed))
+    print('Records failed: ' + str(result.numberRecordsFailed) + '\n')
+    if result.numberRecordsFailed > 0:
+        print('---FAILED RECORDS BY ERROR---')
+        print(result.getFailureReport().to_string(index=False))
+        print('-----------------------------')
+        print('Please check Salesforce for further explanation: Setup > Bulk Data Load Jobs\n')
+
+    return result
+
+def _runIngestJobs(operation: str, chunks: list, objectType: str, externalIdFieldName: str, session: requests.Session, uri: str,
+                   fetchSuccessfulResults: bool, reuseJobs: bool = True):
+    """
+    helper function that submits each CSV payload in `chunks` as an ingest job, waits for them and returns their combined IngestResult
+
+    In a checkpointed run a payload that an earlier attempt already uploaded reuses that job, unless `reuseJobs` is False
+    """
+    # in a checkpointed run, payloads a previous attempt already uploaded reuse that job instead of uploading them again
+    journal = _checkpointJournal
+    payloadHashes = [_hashIngestPayload(operation, objectType, externalIdFieldName, chunk) for chunk in chunks]
+
+    def submit(chunk, payloadHash):
+        if journal is not None and reuseJobs:
+            jobId = journal.getCompletedJobId(payloadHash)
+            if jobId is not None:
+                print('Reusing job ' + jobId + ' from the previous attempt, its data was already uploaded.')
+                return jobId
+        return _submitIngestJob(operation, chunk, objectType, externalIdFieldName, session, uri, payloadHash)
+
+    # submit every chunk as its own job so Salesforce can process them in parallel
+    with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_JOBS, len(chunks))) as executor:
+        jobIds = list(executor.map(submit, chunks, payloadHashes))
+
+    # wait for the jobs to complete, collecting each one's failed rows as soon as it finishes
+    print('Waiting for job to complete...')
+    result = IngestResult(operation, objectType, jobIds)
+    try:
+        jobStatuses = list(waitForJobs('ingest', jobIds, session))
+    finally:
+        # cached query results for this object are out of date once the jobs have run
+        clearQueryCache(objectType)
+
+    if journal is not None:
+        hashesByJobId = dict(zip(jobIds, payloadHashes))
+        for jobId, jsonRes in jobStatuses:
+            _recordJobState(journal, hashesByJobId[jobId], jobId, operation, objectType, jsonRes)
+
+    for jobId, jsonRes in jobStatuses:
+        if jsonRes['state'] != 'JobComplete':
+            raise SalesforceJobError('ingest', jobId, str(jsonRes['state']), jsonRes.get('errorMessage'))
+
+        result.numberRecordsProcessed += jsonRes['numberRecordsProcessed']
+        result.numberRecordsFailed += jsonRes['numberRecordsFailed']
+        if jsonRes['numberRecordsFailed'] > 0:
+            result.failedResults = pd.concat([result.failedResults, _getIngestResults(uri, jobId, 'failedResults', session)], ignore_index=True)
+        if fetchSuccessfulResults:
+            result.successfulResults = pd.concat([result.successfulResults, _getIngestResults(uri, jobId, 'successfulResults', session)], ignore_index=True)
+
+    return result
+
+def _parseIngestErrors(failedDF: pd.DataFrame):
+    """
+    helper function that splits the sf__Error of an ingest job's failed rows into 'Error Code' and 'Error Message' columns
+
+    Salesforce reports errors as CODE:message (e.g. 'UNABLE_TO_LOCK_ROW:unable to obtain exclusive access to this record:--'),
+    errors that don't start with a code get the code UNKNOWN
+    """
+    errors = failedDF['sf__Error'].fillna('').astype(str)
+    parts = errors.str.split(':', n=1, expand=True).reindex(columns=[0, 1])
+    hasCode = parts[0].str.fullmatch(r'[A-Z][A-Z0-9_]*') & parts[1].notna()
+    return failedDF.assign(**{
+        'Error Code': parts[0].where(hasCode, 'UNKNOWN'),
+        'Error Message': parts[1].where(hasCode, errors).str.strip(),
+    })
+
+def _retryFailedRows(result: IngestResult, externalIdFieldName: str, session: requests.Session, uri: str, fetchSuccessfulResults: bool):
+    """
+    helper function that sends the failed rows of `result` with one of RETRYABLE_INGEST_ERRORS again, updating `result`
+
+    The rows are sorted on their parent record (INGEST_PARENT_FIELDS) so records sharing a parent go in the same job,
+    and sent in jobs of at most INGEST_RETRY_BATCH_SIZE rows, one job at a time so they don't compete for the same
+    locks. Rows of a job that fail again are split in half and sent again, until a row that keeps failing has been
+    tried on its own, so a few bad rows are isolated without holding back the rest.
+
+    numberRecordsProcessed is left as it is, it counts each record once, when it was first sent.
+    """
+    failedDF = result.failedResults
+    retryable = failedDF['Error Code'].isin(RETRYABLE_INGEST_ERRORS)
+    if not retryable.any():
+        return
+
+    payloadColumns = [column for column in failedDF.columns if column not in INGEST_RESULT_COLUMNS]
+    parentField = INGEST_PARENT_FIELDS.get(result.objectType)
+
+    def sortOnParent(df):
+        if parentField in df.columns:
+            return df.sort_values(parentField, kind='stable', na_position='last')
+        return df
+
+    retryDF = sortOnParent(failedDF[retryable])
+    unresolved = [failedDF[~retryable]]
+    print('Retrying ' + str(len(retryDF)) + ' record(s) that failed with a temporary error...')
+
+    batches = deque(retryDF.iloc[start:start + INGEST_RETRY_BATCH_SIZE] for start in range(0, len(retryDF), INGEST_RETRY_BATCH_SIZE))
+    while batches:
+        batchDF = batches.popleft()
+        time.sleep(INGEST_RETRY_DELAY)
+        # a payload identical to one that failed must be sent again, not matched to that job by the checkpoint journal
+        retryResult = _runIngestJobs(result.operation, [batchDF[payloadColumns].to_csv(index=False)], result.objectType,
+                                     externalIdFieldName, session, uri, fetchSuccessfulResults, reuseJobs=False)
+        result.jobIds += retryResult.jobIds
+        if fetchSuccessfulResults:
+            result.successfulResults = pd.concat([result.successfulResults, retryResult.successfulResults], ignore_index=True)
+        if retryResult.numberRecordsFailed == 0:
+            continue
+
+        stillFailedDF = _parseIngestErrors(retryResult.failedResults)
+        retryable = stillFailedDF['Error Code'].isin(RETRYABLE_INGEST_ERRORS)
+        unresolved.append(stillFailedDF[~retryable])
+        if len(batchDF) == 1:
+            unresolved.append(stillFailedDF[retryable])
+        elif retryable.any():
+            stillFailedDF = sortOnParent(stillFailedDF[retryable])
+            half = (len(stillFailedDF) + 1) // 2
+            batches.extend(part for part in (stillFailedDF.iloc[:half], stillFailedDF.iloc[half:]) if len(part) > 0)
+
+    result.failedResults = pd.concat(unresolved, ignore_index=True)
+    print(str(result.numberRecordsFailed - len(result.failedResults)) + ' of ' + str(len(retryDF))
+          + ' retried record(s) went through, ' + str(len(result.failedResults)) + ' record(s) still failed.')
+    result.numberRecordsFailed = len(result.failedResults)
+
+def _getIngestResults(uri: str, jobId: str, resultType: str, session: requests.Session):
+    """helper function that downloads an ingest job's successfulResults or failedResults as a Dataframe of strings"""
+    response = session.get(uri+'ingest/'+jobId+'/'+resultType, stream=True)
+    _checkResponse(response, (200,), 'Downloading the ' + resultType + ' of ingest job ' + jobId)
+    response.raw.decode_content = True
+    # keep values exactly as uploaded, only blanks count as missing
+    try:
+        return pd.read_csv(response.raw, dtype=str, keep_default_na=False, na_values=[''])
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame()
+
+def _submitIngestJob(operation: str, importData: str, objectType: str, externalIdFieldName: str, session: requests.Session, uri: str,
+                     payloadHash: str = None):
+    """helper function that creates an ingest job, uploads its data and closes it, returning the job ID
+
+    In a checkpointed run the job is recorded under `payloadHash` as soon as it exists
+    """
     # create data import job
-    data = json.dumps({
+    job = {
         "operation": operation,
         "object": objectType,
         "contentType": "CSV",
         "lineEnding": "LF"
-    })
-    response = session.post(uri+'ingest/', data=data)
+    }
+    if externalIdFieldName is not None:
+        job["externalIdFieldName"] = externalIdFieldName
+    data = json.dumps(job)
+    response = session.post(uri+'ingest/', data=data, headers=JSON_HEADERS)
 
     # Makes sure that the data batch job was created successfully
     if response.status_code == 200:
         if operation == 'insert':
             print('Upload job created.')
+        elif operation == 'upsert':
+            print('Upsert job created.')
         elif operation == 'delete':
             print('Delete job created.')
         elif operation == 'update':
             print('Update job created.')
     else:
-        if operation == 'insert':
-            print('Upload job creation failed.')
-        elif operation == 'delete':
-            print('Delete job creation failed.')
-        elif operation == 'update':
-            print('Update job creation failed.')
-        print(response.json())
-        sys.exit()
+        _checkResponse(response, (200,), operation.capitalize() + ' job creation for ' + objectType)
 
     jobId = response.json().get('id')
+    journal = _checkpointJournal
+    if journal is not None:
+        journal.record(event='job', payloadHash=payloadHash, jobId=jobId, operation=operation, objectType=objectType, state='Open')
 
     # add data to job
-    session.headers.update({'Content-Type': 'text/csv;charset=UTF-8'})
     response = session.put(uri+'ingest/'+jobId+'/batches',
-                           data=importData.encode('utf-8'))
+                           data=importData.encode('utf-8'), headers=CSV_HEADERS)
 
     # Makes sure that the job was created successfully
-    if response.status_code == 201:
-        print('Data added to job.')
-    else:
-        print('Data add failed.')
-        print(response.json())
-        sys.exit()
+    _checkResponse(response, (201,), 'Adding data to ingest job ' + jobId)
+    print('Data added to job.')
 
     # close the job => Salesforce begins processing the job
-    session.headers.update({'Content-Type': 'application/json;charset=utf-8'})
     data = json.dumps({'state': 'UploadComplete'})
-    response = session.patch(uri+'ingest/'+jobId, data=data)
+    response = session.patch(uri+'ingest/'+jobId, data=data, headers=JSON_HEADERS)
+    _checkResponse(response, (200,), 'Closing ingest job ' + jobId)
+    if journal is not None:
+        journal.record(event='job', payloadHash=payloadHash, jobId=jobId, operation=operation, objectType=objectType, state='UploadComplete')
 
-    # wait for job to complete before getting results
-    print('Waiting for job to complete...')
-    jobComplete = False
+    return jobId
+
+def _hashIngestPayload(operation: str, objectType: str, externalIdFieldName: str, importData: str):
+    """helper function that fingerprints what an ingest job would do, so the same upload can be recognized in a later attempt"""
+    digest = hashlib.sha256(json.dumps([operation, objectType, externalIdFieldName]).encode('utf-8'))
+    digest.update(importData.encode('utf-8'))
+    return digest.hexdigest()
+
+def _recordJobState(journal: CheckpointJournal, payloadHash: str, jobId: str, operation: str, objectType: str, jsonRes: dict):
+    """helper function that records an ingest job's final state and counts in the journal"""
+    journal.record(event='job', payloadHash=payloadHash, jobId=jobId, operation=operation, objectType=objectType,
+                   state=jsonRes['state'], numberRecordsProcessed=jsonRes.get('numberRecordsProcessed'),
+                   numberRecordsFailed=jsonRes.get('numberRecordsFailed'))
+
+@contextmanager
+def checkpointedRun(name: str, session: requests.Session, inputs: list = ()):
+    """
+    context manager that makes the uploads inside it resumable
+
+    Every ingest job executeSalesforceIngestJob creates (with a hash of its payload) and every stage
+    functions.runStages finishes is written to a journal in the snapshot directory. If the run stops
+    part way, running it again with the same `name` and `inputs` (files are told apart by their size and
+    modification time) first waits for the jobs the last attempt left running, then skips the stages
+    that finished, reuses the jobs whose payload is unchanged and continues from where it stopped.
+    Records queried before entering may be missing what those jobs uploaded, so when the journal's
+    `resumed` is True they should be queried again inside the run.
+    The journal is deleted once the run succeeds. Plan mode (mirror.PlanningSession) isn't journaled.
+    """
+    global _checkpointJournal
+    if _checkpointJournal is not None or isinstance(session, mirror.PlanningSession):
+        # already inside a checkpointed run, or nothing to checkpoint
+        yield _checkpointJournal
+        return
+
+    fingerprint = [name]
+    for value in inputs:
+        if isinstance(value, str) and os.path.isfile(value):
+            fileStatus = os.stat(value)
+            fingerprint.append([os.path.abspath(value), fileStatus.st_size, fileStatus.st_mtime_ns])
+        else:
+            fingerprint.append(repr(value))
+    runHash = hashlib.sha1(json.dumps(fingerprint).encode('utf-8')).hexdigest()[:12]
+    directory = functions.CONFIG.getPath('GeneralConfiguration', 'snapshotDirectory')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'checkpoint_' + name + '_' + runHash + '.jsonl')
+
+    journal = CheckpointJournal(path)
+    if journal.resumed:
+        print('Continuing the previous attempt of this run (' + path + ').')
+        _settleUnfinishedJobs(journal, session)
+
+    _checkpointJournal = journal
+    try:
+        yield journal
+    except BaseException:
+        print('The run stopped, its progress is saved in ' + path + '. Run it again with the same files to continue.')
+        raise
+    else:
+        os.remove(path)
+    finally:
+        _checkpointJournal = None
+
+def getCheckpointJournal():
+    """function that returns the journal of the checkpointed run in progress, or None (see checkpointedRun)"""
+    return _checkpointJournal
+
+def _settleUnfinishedJobs(journal: CheckpointJournal, session: requests.Session):
+    """
+    helper function that brings the jobs a stopped attempt left behind to an end before the run continues,
+    so their records are in Salesforce (and not uploaded again) when the run queries them
+
+    Jobs that were still open never got all of their data and are aborted, the others are waited on
+    """
+    uri = functions.getConfigValue('GeneralConfiguration', 'uri')
+    unfinishedJobs = {entry['jobId']: entry for entry in journal.getUnfinishedJobs()}
+
+    for jobId, entry in list(unfinishedJobs.items()):
+        if entry['state'] == 'Open':
+            print('Aborting job ' + jobId + ', the previous attempt stopped before uploading all of its data.')
+            response = session.patch(uri+'ingest/'+jobId, data=json.dumps({'state': 'Aborted'}), headers=JSON_HEADERS)
+            if response.status_code == 200:
+                jsonRes = response.json()
+            else:
+                # the job can't be aborted if it was closed after all and only the close wasn't recorded
+                jsonRes = _checkResponse(session.get(uri+'ingest/'+jobId), (200,), 'Checking the status of ingest job ' + jobId).json()
+                if jsonRes['state'] == 'Open':
+                    _checkResponse(response, (200,), 'Aborting ingest job ' + jobId)
+                if jsonRes['state'] not in TERMINAL_JOB_STATES:
+                    print('Job ' + jobId + ' was closed after all, waiting for it instead.')
+                    continue
+            _recordJobState(journal, entry['payloadHash'], jobId, entry['operation'], entry['objectType'], jsonRes)
+            del unfinishedJobs[jobId]
+
+    if unfinishedJobs:
+        print('Waiting for ' + str(len(unfinishedJobs)) + ' job(s) from the previous attempt to complete...')
+        for jobId, jsonRes in waitForJobs('ingest', list(unfinishedJobs), session):
+            entry = unfinishedJobs[jobId]
+            _recordJobState(journal, entry['payloadHash'], jobId, entry['operation'], entry['objectType'], jsonRes)
+        clearQueryCache()
+
+def waitForJob(jobType: str, jobId: str, session: requests.Session, timeout: float = JOB_TIMEOUT):
+    """
+    function that waits for a query or ingest job to finish and returns its final status
 
-    # Checks to see if Job is complete
-    while not jobComplete:
-        response = session.get(uri+'ingest/'+jobId)
+    `jobType` is either 'query' or 'ingest'. Returns as soon as the job reaches any terminal
+    state (JobComplete, Failed or Aborted), so callers need to check the state themselves.
+    """
+    for _, jsonRes in waitForJobs(jobType, [jobId], session, timeout):
+        return jsonRes
+
+def waitForJobs(jobType: str, jobIds: list, session: requests.Session, timeout: float = JOB_TIMEOUT):
+    """
+    function that waits on several query or ingest jobs at once
+
+    Yields `(jobId, status)` for each job as soon as it reaches a terminal state.
+    Each job is polled with exponential backoff and jitter, starting at POLL_INITIAL_DELAY and
+    capped at POLL_MAX_DELAY. Raises TimeoutError if any job is still running after `timeout` seconds.
+    """
+    uri = functions.getConfigValue('GeneralConfiguration', 'uri')
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    # heap of (time of next poll, job ID, current delay), so the job due soonest is always polled next
+    pending = [(time.monotonic(), jobId, POLL_INITIAL_DELAY) for jobId in jobIds]
+    heapq.heapify(pending)
+
+    while pending:
+        pollAt, jobId, delay = heapq.heappop(pending)
+        time.sleep(max(0, pollAt - time.monotonic()))
+
+        response = _checkResponse(session.get(uri+jobType+'/'+jobId), (200,), 'Checking the status of ' + jobType + ' job ' + jobId)
         jsonRes = response.json()
-        if str(jsonRes['state']) == 'JobComplete':
-            jobComplete = True
-        elif str(jsonRes['state']) == 'Failed':
-            print('Job Failed. Please check Bulk Data Load Jobs in Salesforce Setup')
-            print(jsonRes['errorMessage'])
-            sys.exit()
-        time.sleep(0.25)
+        if str(jsonRes['state']) in TERMINAL_JOB_STATES:
+            yield jobId, jsonRes
+        elif deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError('Job ' + jobId + ' did not finish within ' + str(timeout) + ' seconds')
+        else:
+            delay = min(delay * 2, POLL_MAX_DELAY)
+            pollAt = time.monotonic() + random.uniform(delay / 2, delay)
+            if deadline is not None:
+                pollAt = min(pollAt, deadline)
+            heapq.heappush(pending, (pollAt, jobId, delay))
 
-    if operation == 'insert':
-        print('Upload complete!\n')
-    if operation == 'update':
-        print('Update complete!\n')
-    elif operation == 'delete':
-        print('Deletion complete.\n')
+def clearQueryCache(objectType: str = None):
+    """
+    function that empties the query cache
 
-    # get job results to display to user
-    print('Job results:')
-    response = session.get(uri+'ingest/'+jobId)
-    jsonRes = response.json()
-    print('Records processed: ' + str(jsonRes['numberRecordsProcessed']))
-    print('Records failed: ' + str(jsonRes['numberRecordsFailed']) + '\n')
-    if jsonRes['numberRecordsFailed'] > 0:
-        response = session.get(uri+'ingest/'+jobId+'/failedResults')
-        print('---ERROR MESSAGE---')
-        print(response.text)
-        print('-------------------')
-        print('Please check Salesforce for further explanation: Setup > Bulk Data Load Jobs\n')
+    Query results are cached per org and SOQL statement (ignoring case and whitespace) for
+    QUERY_CACHE_TTL seconds, keeping the QUERY_CACHE_SIZE most recently used results.
+    If `objectType` is given, only results that read from that object are removed.
+    executeSalesforceIngestJob calls this for every object it writes to.
+    """
+    with _queryCacheLock:
+        if objectType is None:
+            _queryCache.clear()
+            return
+        objectType = objectType.lower()
+        for key in [key for key, (_, objectTypes, _) in _queryCache.items() if objectType in objectTypes]:
+            del _queryCache[key]
+
+def _queryCacheKey(query: str, uri: str):
+    """helper function that builds the query cache key from the org's host and the normalised SOQL"""
+    # SOQL keywords and field names are case insensitive, string literals are not
+    parts = re.split(r"('(?:[^'\\]|\\.)*')", query)
+    normalizedQuery = ''.join(part if part.startswith("'") else ' '.join(part.lower().split()) for part in parts)
+    return urlsplit(uri).netloc, normalizedQuery
+
+def _getCachedQuery(query: str, uri: str):
+    """helper function that returns a copy of a cached query result, or None if it isn't cached"""
+    key = _queryCacheKey(query, uri)
+    with _queryCacheLock:
+        if key not in _queryCache:
+            return None
+        storedAt, _, df = _queryCache[key]
+        if time.monotonic() - storedAt > QUERY_CACHE_TTL:
+            del _queryCache[key]
+            return None
+        _queryCache.move_to_end(key)
+    # callers are free to modify what they get back, so never hand out the cached Dataframe itself
+    return df.copy()
+
+def _putCachedQuery(query: str, uri: str, df: pd.DataFrame):
+    """helper function that stores a query result, evicting the least recently used results"""
+    key = _queryCacheKey(query, uri)
+    objectTypes = frozenset(re.findall(r'\bfrom\s+(\w+)', key[1]))
+    with _queryCacheLock:
+        _queryCache[key] = (time.monotonic(), objectTypes, df)
+        _queryCache.move_to_end(key)
+        while len(_queryCache) > QUERY_CACHE_SIZE:
+            _queryCache.popitem(last=False)
+
+def _splitCsvPayload(csvData: str, maxBytes: int):
+    """helper function that splits CSV text into pieces of at most `maxBytes`, repeating the header in each piece"""
+    if len(csvData.encode('utf-8')) <= maxBytes:
+        yield csvData
+        return
+
+    records = _iterCsvRecords(csvData)
+    header = next(records)
+    headerSize = len(header.encode('utf-8')) + 1
+
+    chunk = [header]
+    chunkSize = headerSize
+    for record in records:
+        recordSize = len(record.encode('utf-8')) + 1
+        if chunkSize + recordSize > maxBytes and len(chunk) > 1:
+            yield '\n'.join(chunk) + '\n'
+            chunk = [header]
+            chunkSize = headerSize
+        chunk.append(record)
+        chunkSize += recordSize
+
+    if len(chunk) > 1:
+        yield '\n'.join(chunk) + '\n'
+
+def _iterCsvRecords(csvData: str):
+    """helper function that yields whole CSV records, keeping quoted fields that contain newlines together"""
+    lines = []
+    inQuotes = False
+    for line in csvData.split('\n'):
+        lines.append(line)
+        # an odd number of quotes on a line means it opens or closes a quoted field
+        if line.count('"') % 2 == 1:
+            inQuotes = not inQuotes
+        if not inQuotes:
+            record = '\n'.join(lines)
+            lines = []
+            if record != '':
+                yield record
+
+    if lines:
+        yield '\n'.join(lines)